@@ -1,11 +1,10 @@
 # -*- coding: utf-8 -*-
-from gevent import monkey, sleep
+from gevent import monkey, sleep, spawn
 monkey.patch_all()
 ##################################
 import argparse
 import logging
 import logging.config
-import iso8601
 import json
 import sys
 import os
@@ -14,9 +13,10 @@ from urlparse import urljoin
 from dateutil.tz import tzlocal
 from copy import deepcopy
 from datetime import timedelta, datetime
+from functools import partial
 from pytz import timezone
 from couchdb import Database, Session
-from couchdb.http import HTTPError, RETRYABLE_ERRORS
+from couchdb.http import HTTPError, ResourceConflict, RETRYABLE_ERRORS
 from gevent.event import Event
 from gevent.lock import BoundedSemaphore
 from gevent.subprocess import call
@@ -30,9 +30,15 @@ from .utils import (
     patch_tender_data,
     delete_mapping,
     generate_request_id,
-    filter_amount
+    parse_date,
+    PublicDocumentBuilder,
+    BidsLog,
+    NOT_PLANNED_EXIT_CODE
 )
 from .executor import AuctionsExecutor
+from .forms import BidsValidator
+from .host import AuctionsHost
+from .persistence import WriteBehindPersister
 
 from .templates import (
     prepare_initial_bid_stage,
@@ -126,7 +132,8 @@ class Auction(object):
                  worker_defaults={},
                  auction_data={},
                  lot_id=None,
-                 activate=False):
+                 activate=False,
+                 host=None):
         super(Auction, self).__init__()
         self.generate_request_id()
         self.tender_id = tender_id
@@ -142,19 +149,35 @@ class Auction(object):
             )
         )
         self.activate = activate
+        self.host = host
+        self.journal_fields = {}
+        if self.host:
+            # Set on log records, the host journal handler has no tender
+            self.journal_fields = {
+                'TENDER_ID': tender_id,
+                'TENDERS_API_VERSION': worker_defaults["TENDERS_API_VERSION"]
+            }
+            if lot_id:
+                self.journal_fields['TENDER_LOT_ID'] = lot_id
         if auction_data:
             self.debug = True
-            logger.setLevel(logging.DEBUG)
+            if not self.host:
+                # The host process logs for all of its auctions
+                logger.setLevel(logging.DEBUG)
             self._auction_data = auction_data
         else:
             self.debug = False
         self.session = RequestsSession()
         self._end_auction_event = Event()
         self.bids_actions = BoundedSemaphore()
+        self.bids_validator = BidsValidator(self)
         self.worker_defaults = worker_defaults
-        self._bids_data = {}
-        self.db = Database(str(self.worker_defaults["COUCH_DATABASE"]),
-                           session=Session(retry_delays=range(10)))
+        self._bids_data = BidsLog()
+        if self.host:
+            self.db = self.host.db
+        else:
+            self.db = Database(str(self.worker_defaults["COUCH_DATABASE"]),
+                               session=Session(retry_delays=range(10)))
         self.audit = {}
         self.retries = 10
         self.bidders_count = 0
@@ -163,23 +186,27 @@ class Auction(object):
         self.bidders_coeficient = {}
         self.features = None
         self.mapping = {}
+        self.bidders_index = {}
         self.rounds_stages = []
-
+        self.stages_index = []
+        self.round_bids_index = {}
+        self.public_document_builder = PublicDocumentBuilder()
+        self.persister = WriteBehindPersister(
+            self.save_auction_document,
+            flush_interval=self.worker_defaults.get("DOCUMENT_FLUSH_INTERVAL", 1),
+            spawn=partial(self.host.spawn, self) if self.host else spawn
+        )
 
     def generate_request_id(self):
         self.request_id = generate_request_id()
 
     def prepare_public_document(self):
-        public_document = deepcopy(dict(self.auction_document))
         not_last_stage = self.auction_document["current_stage"] not in (len(self.auction_document["stages"]) - 1,
                                                                         len(self.auction_document["stages"]) - 2,)
-        if self.features and not_last_stage:
-            for stage_name in ['initial_bids', 'stages', 'results']:
-                public_document[stage_name] = map(
-                    filter_amount,
-                    public_document[stage_name]
-                )
-        return public_document
+        return self.public_document_builder.build(
+            self.auction_document,
+            hide_amounts=bool(self.features and not_last_stage)
+        )
 
     def get_auction_document(self, force=False):
         retries = self.retries
@@ -225,6 +252,9 @@ class Auction(object):
                                        "MESSAGE_ID": AUCTION_WORKER_DB_SAVE_DOC})
                     self.auction_document['_rev'] = response[1]
                     return response
+            except ResourceConflict, e:
+                logger.warning("Rev conflict while save document: {}".format(e),
+                               extra={'MESSAGE_ID': AUCTION_WORKER_DB_SAVE_DOC_ERROR})
             except HTTPError, e:
                 logger.error("Error while save document: {}".format(e),
                              extra={'MESSAGE_ID': AUCTION_WORKER_DB_SAVE_DOC_ERROR})
@@ -243,16 +273,56 @@ class Auction(object):
             retries -= 1
 
     def add_bid(self, round_id, bid):
-        if round_id not in self._bids_data:
-            self._bids_data[round_id] = []
-        self._bids_data[round_id].append(bid)
+        return self._bids_data.append(round_id, bid)
+
+    def prepare_stages_index(self):
+        self.stages_index = []
+        rounds_ends = self.rounds_stages + [(self.bidders_count + 1) * ROUNDS + 1]
+        for round_number, end_stage in enumerate(rounds_ends):
+            round_number = min(round_number, ROUNDS)
+            for stage in xrange(len(self.stages_index), end_stage):
+                turn = stage - (round_number * (self.bidders_count + 1) - self.bidders_count) + 1
+                self.stages_index.append((round_number, turn))
+
+    def prepare_bidders_index(self):
+        self.bidders_index = {}
+        for bid_info in self.bidders_data:
+            self.bidders_index[bid_info['id']] = {
+                'data': bid_info,
+                'coeficient': self.bidders_coeficient.get(bid_info['id']) if self.features else None,
+                'name': self.mapping.get(bid_info['id'])
+            }
+        self.bids_validator.reset()
 
     def get_round_number(self, stage):
-        for index, end_stage in enumerate(self.rounds_stages):
-            if stage < end_stage:
-                return index
+        if stage < 0:
+            return 0 if self.rounds_stages else ROUNDS
+        if stage < len(self.stages_index):
+            return self.stages_index[stage][0]
         return ROUNDS
 
+    def get_round_bids_index(self, round_number):
+        # Built from the document when the worker did not lay out the round
+        # itself, e.g. after it resumed a running auction
+        if round_number not in self.round_bids_index:
+            if round_number == 0:
+                stages = enumerate(self.auction_document["initial_bids"])
+            else:
+                stages = ((stage, self.auction_document["stages"][stage])
+                          for stage in xrange(*self.get_round_stages(round_number)))
+            self.round_bids_index[round_number] = dict(
+                (bid['bidder_id'], index) for index, bid in stages
+            )
+        return self.round_bids_index[round_number]
+
+    def get_round_latest_bids(self, round_number):
+        if round_number == 0:
+            bids = self.auction_document["initial_bids"]
+        else:
+            bids = self.auction_document["stages"]
+        round_index = self.get_round_bids_index(round_number)
+        return [bids[round_index[bid_info['id']]] for bid_info in self.bidders_data]
+
     def get_round_stages(self, round_num):
         return (round_num * (self.bidders_count + 1) - self.bidders_count,
                 round_num * (self.bidders_count + 1), )
@@ -285,9 +355,7 @@ class Auction(object):
             self.audit['timeline']['round_{}'.format(round_number)] = {}
 
     def approve_audit_info_on_bid_stage(self):
-        turn_in_round = self.current_stage - (
-            self.current_round * (self.bidders_count + 1) - self.bidders_count
-        ) + 1
+        turn_in_round = self.stages_index[self.current_stage][1]
         round_label = 'round_{}'.format(self.current_round)
         turn_label = 'turn_{}'.format(turn_in_round)
         self.audit['timeline'][round_label][turn_label] = {
@@ -321,13 +389,15 @@ class Auction(object):
             self.audit['timeline']['results']['bids'].append(bid_result_audit)
 
     def convert_datetime(self, datetime_stamp):
-        return iso8601.parse_date(datetime_stamp).astimezone(SCHEDULER.timezone)
+        return parse_date(datetime_stamp, SCHEDULER.timezone)
 
     def get_auction_info(self, prepare=False):
         if self.lot_id:
             multiple_lots_tenders.get_auction_info(self, prepare)
         else:
             simple_tender.get_auction_info(self, prepare)
+        self.prepare_stages_index()
+        self.prepare_bidders_index()
 
     def prepare_auction_stages(self):
         # Initital Bids
@@ -415,26 +485,31 @@ class Auction(object):
             simple_tender.prepare_auction_and_participation_urls(self)
 
 
-    def prepare_tasks(self, tender_id, start_date):
-        cmd = deepcopy(sys.argv)
-        cmd[0] = os.path.abspath(cmd[0])
-        cmd[1] = 'run'
-        home_dir = os.path.expanduser('~')
-        with open(os.path.join(home_dir,
-                  SYSTEMD_RELATIVE_PATH.format(self.auction_doc_id, 'service')),
-                  'w') as service_file:
-            template = get_template('systemd.service')
-            logger.info(
-                "Write configuration to {}".format(service_file.name),
-                extra={"JOURNAL_REQUEST_ID": self.request_id,
-                       "MESSAGE_ID": AUCTION_WORKER_SYSTEMD_UNITS_WRITE_SERVICE_CONFIG})
-            service_file.write(
-                template.render(cmd=' '.join(cmd),
-                                description='Auction ' + tender_id,
-                                id='auction_' + self.auction_doc_id + '.service'),
+    def prepare_tasks(self, tender_id, start_date, cmd=None):
+        if cmd is None:
+            cmd = deepcopy(sys.argv)
+            cmd[0] = os.path.abspath(cmd[0])
+            cmd[1] = 'run'
+            if ',' in cmd[2]:
+                # Planned in batch, run only this auction
+                cmd[2] = self.tender_id
+                if self.lot_id:
+                    cmd += ['--lot', self.lot_id]
+        start_offset = timedelta(minutes=15)
+        handoff_socket = (self.worker_defaults.get('WORKER_HOST_SOCKET') or
+                          self.worker_defaults.get('WORKER_POOL_SOCKET'))
+        if handoff_socket:
+            # Warm pool workers and the auctions host start instantly,
+            # hand the auction off late
+            cmd = [os.path.join(os.path.dirname(cmd[0]), 'auction_worker_handoff'),
+                   self.tender_id, handoff_socket,
+                   '--with_api_version', self.worker_defaults['TENDERS_API_VERSION']]
+            if self.lot_id:
+                cmd += ['--lot', self.lot_id]
+            start_offset = timedelta(
+                seconds=self.worker_defaults.get('WORKER_POOL_START_OFFSET', 60)
             )
-
-        start_time = (start_date - timedelta(minutes=15)).astimezone(tzlocal())
+        start_time = (start_date - start_offset).astimezone(tzlocal())
         extra_start_time = datetime.now(tzlocal()) + timedelta(seconds=15)
         if extra_start_time > start_time:
             logger.warning(
@@ -449,7 +524,22 @@ class Auction(object):
                     extra={"JOURNAL_REQUEST_ID": self.request_id,
                            "MESSAGE_ID": AUCTION_WORKER_SYSTEMD_UNITS_NO_TIME}
                 )
-                sys.exit()
+                return False
+
+        home_dir = os.path.expanduser('~')
+        with open(os.path.join(home_dir,
+                  SYSTEMD_RELATIVE_PATH.format(self.auction_doc_id, 'service')),
+                  'w') as service_file:
+            template = get_template('systemd.service')
+            logger.info(
+                "Write configuration to {}".format(service_file.name),
+                extra={"JOURNAL_REQUEST_ID": self.request_id,
+                       "MESSAGE_ID": AUCTION_WORKER_SYSTEMD_UNITS_WRITE_SERVICE_CONFIG})
+            service_file.write(
+                template.render(cmd=' '.join(cmd),
+                                description='Auction ' + tender_id,
+                                id='auction_' + self.auction_doc_id + '.service'),
+            )
 
         with open(os.path.join(home_dir, SYSTEMD_RELATIVE_PATH.format(self.auction_doc_id, 'timer')), 'w') as timer_file:
             template = get_template('systemd.timer')
@@ -463,54 +553,27 @@ class Auction(object):
                 description='Auction ' + tender_id)
             )
         if self.activate:
-            logger.info(
-                "Reload Systemd",
-                extra={"JOURNAL_REQUEST_ID": self.request_id,
-                       "MESSAGE_ID": AUCTION_WORKER_SYSTEMD_UNITS_RELOAD}
-            )
-            response = call(['/usr/bin/systemctl', '--user', 'daemon-reload'])
-            logger.info(
-                "Systemctl return code: {}".format(response),
-                extra={"JOURNAL_REQUEST_ID": self.request_id,
-                       "MESSAGE_ID": AUCTION_WORKER_SYSTEMD_UNITS_SYSTEMCTL_RESPONSE}
-            )
-            self.activate_systemd_unit()
+            activate_systemd_units([self.auction_doc_id],
+                                   extra={"JOURNAL_REQUEST_ID": self.request_id})
+        return True
 
     def activate_systemd_unit(self):
-        logger.info(
-            "Start timer",
-            extra={"JOURNAL_REQUEST_ID": self.request_id,
-                   "MESSAGE_ID": AUCTION_WORKER_SYSTEMD_UNITS_START_TIMER}
-        )
-        timer_file = 'auction_' + '.'.join([self.auction_doc_id, 'timer'])
-        response = call(['/usr/bin/systemctl', '--user',
-                         'reload-or-restart', timer_file])
-        logger.info(
-            "Systemctl 'reload-or-restart' return code: {}".format(response),
-            extra={"JOURNAL_REQUEST_ID": self.request_id,
-                   "MESSAGE_ID": AUCTION_WORKER_SYSTEMD_UNITS_SYSTEMCTL_RELOAD_OR_RESTART}
-        )
-        response = call(['/usr/bin/systemctl', '--user',
-                         'enable', timer_file])
-        logger.info(
-            "Systemctl 'enable' return code: {}".format(response),
-            extra={"JOURNAL_REQUEST_ID": self.request_id,
-                   "MESSAGE_ID": AUCTION_WORKER_SYSTEMD_UNITS_SYSTEMCTL_ENABLE}
-        )
-
-
+        activate_systemd_units([self.auction_doc_id], daemon_reload=False,
+                               extra={"JOURNAL_REQUEST_ID": self.request_id})
 
-    def prepare_systemd_units(self):
+    def prepare_systemd_units(self, cmd=None):
         self.generate_request_id()
         self.get_auction_document()
         if len(self.auction_document['stages']) >= 1:
-            self.prepare_tasks(
+            return self.prepare_tasks(
                 self.auction_document['tenderID'],
-                self.convert_datetime(self.auction_document['stages'][0]['start'])
+                self.convert_datetime(self.auction_document['stages'][0]['start']),
+                cmd=cmd
             )
         else:
             logger.error("Not valid auction_document",
                          extra={'MESSAGE_ID': AUCTION_WORKER_SYSTEMD_UNITS_NOT_VALID_DOCUMENT})
+        return False
 
     ###########################################################################
     #                       Runtime methods
@@ -531,7 +594,7 @@ class Auction(object):
                 self.auction_document['stages'][0]['start']
             ),
             name="Start of Auction",
-            id="Start of Auction"
+            id=self.get_job_id("Start of Auction")
         )
         round_number += 1
 
@@ -541,7 +604,7 @@ class Auction(object):
                 self.auction_document['stages'][1]['start']
             ),
             name="End of Pause Stage: [0 -> 1]",
-            id="End of Pause Stage: [0 -> 1]"
+            id=self.get_job_id("End of Pause Stage: [0 -> 1]")
         )
         round_number += 1
         for index in xrange(2, len(self.auction_document['stages'])):
@@ -553,7 +616,7 @@ class Auction(object):
                         self.auction_document['stages'][index]['start']
                     ),
                     name="End of Bids Stage: [{} -> {}]".format(index - 1, index),
-                    id="End of Bids Stage: [{} -> {}]".format(index - 1, index)
+                    id=self.get_job_id("End of Bids Stage: [{} -> {}]".format(index - 1, index))
                 )
             elif self.auction_document['stages'][index - 1]['type'] == 'pause':
                 SCHEDULER.add_job(
@@ -563,7 +626,7 @@ class Auction(object):
                         self.auction_document['stages'][index]['start']
                     ),
                     name="End of Pause Stage: [{} -> {}]".format(index - 1, index),
-                    id="End of Pause Stage: [{} -> {}]".format(index - 1, index)
+                    id=self.get_job_id("End of Pause Stage: [{} -> {}]".format(index - 1, index))
                 )
             round_number += 1
         logger.info(
@@ -571,7 +634,14 @@ class Auction(object):
             extra={"JOURNAL_REQUEST_ID": self.request_id,
                    "MESSAGE_ID": AUCTION_WORKER_SERVICE_PREPARE_SERVER}
         )
-        self.server = run_server(self, self.convert_datetime(self.auction_document['stages'][-2]['start']), logger)
+        if self.host:
+            start_server = self.host.run_server
+        else:
+            start_server = run_server
+        self.server = start_server(self, self.convert_datetime(self.auction_document['stages'][-2]['start']), logger)
+
+    def get_job_id(self, name):
+        return "{}: {}".format(self.auction_doc_id, name)
 
     def wait_to_end(self):
         self._end_auction_event.wait()
@@ -588,7 +658,6 @@ class Auction(object):
                    "MESSAGE_ID": AUCTION_WORKER_SERVICE_START_AUCTION}
         )
         self.get_auction_info()
-        self.get_auction_document()
         # Initital Bids
         bids = deepcopy(self.bidders_data)
         self.auction_document["initial_bids"] = []
@@ -630,16 +699,12 @@ class Auction(object):
         else:
             self.auction_document["current_stage"] = 0
 
-        all_bids = deepcopy(self.auction_document["initial_bids"])
-        minimal_bids = []
-        for bid_info in self.bidders_data:
-            minimal_bids.append(get_latest_bid_for_bidder(
-                all_bids, str(bid_info['id'])
-            ))
-
-        minimal_bids = self.filter_bids_keys(sorting_by_amount(minimal_bids))
+        self.round_bids_index = {}
+        minimal_bids = self.filter_bids_keys(
+            sorting_by_amount(self.get_round_latest_bids(0))
+        )
         self.update_future_bidding_orders(minimal_bids)
-        self.save_auction_document()
+        self.persister.schedule()
 
     def end_first_pause(self, switch_to_round=None):
         self.generate_request_id()
@@ -649,44 +714,36 @@ class Auction(object):
                    "MESSAGE_ID": AUCTION_WORKER_SERVICE_END_FIRST_PAUSE}
         )
         self.bids_actions.acquire()
-        self.get_auction_document()
+        self._bids_data.seal(self.auction_document["current_stage"])
 
         if isinstance(switch_to_round, int):
             self.auction_document["current_stage"] = switch_to_round
         else:
             self.auction_document["current_stage"] += 1
 
-        self.save_auction_document()
+        self.prepare_bids_validator()
         self.bids_actions.release()
+        self.persister.schedule()
 
     def end_bids_stage(self, switch_to_round=None):
         self.generate_request_id()
-        self.bids_actions.acquire()
-        self.get_auction_document()
         logger.info(
             '---------------- End Bids Stage ----------------',
             extra={"JOURNAL_REQUEST_ID": self.request_id,
                    "MESSAGE_ID": AUCTION_WORKER_SERVICE_END_BID_STAGE}
         )
-
+        # Only the in-memory stage switch is under the lock, bids of the
+        # closed stage are sealed and later ones are rejected
+        self.bids_actions.acquire()
         self.current_round = self.get_round_number(
             self.auction_document["current_stage"]
         )
         self.current_stage = self.auction_document["current_stage"]
+        self._bids_data.seal(self.current_stage)
 
         if self.approve_bids_information():
-
-            start_stage, end_stage = self.get_round_stages(self.current_round)
-            all_bids = deepcopy(
-                self.auction_document["stages"][start_stage:end_stage]
-            )
-            minimal_bids = []
-            for bid_info in self.bidders_data:
-                minimal_bids.append(
-                    get_latest_bid_for_bidder(all_bids, bid_info['id'])
-                )
             minimal_bids = self.filter_bids_keys(
-                sorting_by_amount(minimal_bids)
+                sorting_by_amount(self.get_round_latest_bids(self.current_round))
             )
             self.update_future_bidding_orders(minimal_bids)
 
@@ -696,42 +753,54 @@ class Auction(object):
             self.auction_document["current_stage"] = switch_to_round
         else:
             self.auction_document["current_stage"] += 1
+        self.prepare_bids_validator()
+        self.bids_actions.release()
 
         logger.info('---------------- Start stage {0} ----------------'.format(
             self.auction_document["current_stage"]),
             extra={"JOURNAL_REQUEST_ID": self.request_id,
                    "MESSAGE_ID": AUCTION_WORKER_SERVICE_START_STAGE}
         )
-        self.save_auction_document()
+        self.persister.schedule()
         if self.auction_document["stages"][self.auction_document["current_stage"]]['type'] == 'pre_announcement':
             self.end_auction()
-        self.bids_actions.release()
         if self.auction_document["current_stage"] == (len(self.auction_document["stages"]) - 1):
             self._end_auction_event.set()
 
     def next_stage(self, switch_to_round=None):
         self.generate_request_id()
         self.bids_actions.acquire()
-        self.get_auction_document()
+        self._bids_data.seal(self.auction_document["current_stage"])
 
         if isinstance(switch_to_round, int):
             self.auction_document["current_stage"] = switch_to_round
         else:
             self.auction_document["current_stage"] += 1
-        self.save_auction_document()
+        self.prepare_bids_validator()
         self.bids_actions.release()
+        self.persister.schedule()
         logger.info('---------------- Start stage {0} ----------------'.format(
             self.auction_document["current_stage"]),
             extra={"JOURNAL_REQUEST_ID": self.request_id,
                    "MESSAGE_ID": AUCTION_WORKER_SERVICE_START_NEXT_STAGE}
         )
 
+    def prepare_bids_validator(self):
+        # Precompute bid ceilings of the started stage, post_bid compiles
+        # them itself if the stage can not be prepared yet
+        try:
+            self.bids_validator.prepare(self.auction_document)
+        except (KeyError, IndexError), e:
+            logger.warning("Bids validator not prepared, missing {}".format(e),
+                           extra={"JOURNAL_REQUEST_ID": self.request_id})
+
     def end_auction(self):
         logger.info(
             '---------------- End auction ----------------',
             extra={"JOURNAL_REQUEST_ID": self.request_id,
                    "MESSAGE_ID": AUCTION_WORKER_SERVICE_END_AUCTION}
         )
+        self.persister.flush()
         logger.debug("Stop server", extra={"JOURNAL_REQUEST_ID": self.request_id})
         if self.server:
             self.server.stop()
@@ -761,10 +830,11 @@ class Auction(object):
                 extra={"JOURNAL_REQUEST_ID": self.request_id}
             )
             sleep(10)
-            self.save_auction_document()
+            self.persister.flush()
         else:
             if self.put_auction_data():
-                self.save_auction_document()
+                self.persister.flush()
+        self.persister.stop()
         logger.debug(
             "Fire 'stop auction worker' event",
             extra={"JOURNAL_REQUEST_ID": self.request_id}
@@ -806,14 +876,23 @@ class Auction(object):
         current_round = self.get_round_number(
             self.auction_document["current_stage"]
         )
-        for round_number in range(current_round + 1, ROUNDS + 1):
-            for index, stage in enumerate(
-                    range(*self.get_round_stages(round_number))):
-
-                self.auction_document["stages"][stage] = prepare_bids_stage(
-                    self.auction_document["stages"][stage],
-                    bids[index]
-                )
+        rounds = range(current_round + 1, ROUNDS + 1)
+        for round_number in rounds:
+            self.round_bids_index[round_number] = {}
+        # Stages of the following rounds differ in start only: every bid is
+        # prepared once and stages which already hold it are left as they are
+        for index, bid in enumerate(bids):
+            bid_stage = None
+            for round_number in rounds:
+                stage = self.get_round_stages(round_number)[0] + index
+                exist_stage = self.auction_document["stages"][stage]
+                if bid_stage is None:
+                    bid_stage = prepare_bids_stage(dict(exist_stage), bid)
+                new_stage = dict(bid_stage, start=str(exist_stage['start']),
+                                 label=dict(bid_stage['label']))
+                if new_stage != exist_stage:
+                    self.auction_document["stages"][stage] = new_stage
+                self.round_bids_index[round_number][bid['bidder_id']] = stage
 
         self.auction_document["results"] = []
         for item in bids:
@@ -909,6 +988,64 @@ class Auction(object):
                         extra={'MESSAGE_ID': AUCTION_WORKER_SERVICE_AUCTION_NOT_FOUND})
 
 
+def plan_auction(auction, planning_procerude=PLANNING_FULL, cmd=None):
+    """
+    Plan auction, returns True when its systemd units were written, False
+    when they could not be (they must not be activated) and None when the
+    procedure writes no units
+    """
+    if planning_procerude == PLANNING_FULL:
+        auction.prepare_auction_document()
+        if not auction.debug:
+            return auction.prepare_tasks(
+                auction._auction_data["data"]['tenderID'],
+                auction.startDate,
+                cmd=cmd
+            )
+    elif planning_procerude == PLANNING_PARTIAL_DB:
+        auction.prepare_auction_document()
+    elif planning_procerude == PLANNING_PARTIAL_CRON:
+        return auction.prepare_systemd_units(cmd=cmd)
+
+
+def activate_systemd_units(auction_doc_ids, daemon_reload=True, extra={}):
+    """Start and enable timers of all given auctions with single systemctl calls"""
+    if daemon_reload:
+        logger.info("Reload Systemd",
+                    extra=dict(extra, MESSAGE_ID=AUCTION_WORKER_SYSTEMD_UNITS_RELOAD))
+        response = call(['/usr/bin/systemctl', '--user', 'daemon-reload'])
+        logger.info(
+            "Systemctl return code: {}".format(response),
+            extra=dict(extra, MESSAGE_ID=AUCTION_WORKER_SYSTEMD_UNITS_SYSTEMCTL_RESPONSE)
+        )
+    # A missing unit fails the whole systemctl call, skip such auctions
+    home_dir = os.path.expanduser('~')
+    timer_files = []
+    for auction_doc_id in auction_doc_ids:
+        if all(os.path.isfile(os.path.join(home_dir, SYSTEMD_RELATIVE_PATH.format(auction_doc_id, unit)))
+               for unit in ('service', 'timer')):
+            timer_files.append('auction_{}.timer'.format(auction_doc_id))
+        else:
+            logger.warning("Auction {} has no systemd units, skip it".format(auction_doc_id),
+                           extra=extra)
+    if not timer_files:
+        return
+    logger.info("Start timers: {}".format(', '.join(timer_files)),
+                extra=dict(extra, MESSAGE_ID=AUCTION_WORKER_SYSTEMD_UNITS_START_TIMER))
+    response = call(['/usr/bin/systemctl', '--user',
+                     'reload-or-restart'] + timer_files)
+    logger.info(
+        "Systemctl 'reload-or-restart' return code: {}".format(response),
+        extra=dict(extra, MESSAGE_ID=AUCTION_WORKER_SYSTEMD_UNITS_SYSTEMCTL_RELOAD_OR_RESTART)
+    )
+    response = call(['/usr/bin/systemctl', '--user',
+                     'enable'] + timer_files)
+    logger.info(
+        "Systemctl 'enable' return code: {}".format(response),
+        extra=dict(extra, MESSAGE_ID=AUCTION_WORKER_SYSTEMD_UNITS_SYSTEMCTL_ENABLE)
+    )
+
+
 def cleanup():
     today_datestamp = datetime.now()
     today_datestamp = today_datestamp.replace(
@@ -960,7 +1097,10 @@ def cleanup():
 def main():
     parser = argparse.ArgumentParser(description='---- Auction ----')
     parser.add_argument('cmd', type=str, help='')
-    parser.add_argument('auction_doc_id', type=str, help='auction_doc_id')
+    parser.add_argument('auction_doc_id', type=str,
+                        help='auction_doc_id (comma separated list for host, '
+                             'planning and activate, "-" for a host serving '
+                             'WORKER_HOST_SOCKET only)')
     parser.add_argument('auction_worker_config', type=str,
                         help='Auction Worker Configuration File')
     parser.add_argument('--auction_info', type=str, help='Auction File')
@@ -982,7 +1122,7 @@ def main():
         worker_defaults = json.load(open(args.auction_worker_config))
         if args.with_api_version:
             worker_defaults['TENDERS_API_VERSION'] = args.with_api_version
-        if args.cmd != 'cleanup':
+        if args.cmd not in ('cleanup', 'host') and ',' not in args.auction_doc_id:
             worker_defaults['handlers']['journal']['TENDER_ID'] = args.auction_doc_id
             if args.lot:
                 worker_defaults['handlers']['journal']['TENDER_LOT_ID'] = args.lot
@@ -994,6 +1134,59 @@ def main():
         print "Auction worker defaults config not exists!!!"
         sys.exit(1)
 
+    if args.cmd == 'host':
+        host = AuctionsHost(worker_defaults,
+                            socket_path=worker_defaults.get('WORKER_HOST_SOCKET'))
+        auctions = []
+        for auction_doc_id in args.auction_doc_id.split(','):
+            if auction_doc_id in ('', '-'):
+                continue
+            tender_id, _, lot_id = auction_doc_id.partition('_')
+            auctions.append(Auction(tender_id,
+                                    worker_defaults=worker_defaults,
+                                    lot_id=lot_id or None,
+                                    host=host))
+        SCHEDULER.start()
+        host.run(auctions)
+        SCHEDULER.shutdown()
+        return
+
+    if args.cmd == 'activate':
+        if args.lot:
+            auction_doc_ids = ["_".join([args.auction_doc_id, args.lot])]
+        else:
+            auction_doc_ids = args.auction_doc_id.split(',')
+        activate_systemd_units(auction_doc_ids, daemon_reload=False)
+        return
+
+    if args.planning_procerude:
+        planning_procerude = args.planning_procerude
+    else:
+        planning_procerude = worker_defaults.get('planning_procerude', PLANNING_FULL)
+
+    if args.cmd == 'planning' and ',' in args.auction_doc_id:
+        planned = []
+        not_planned = []
+        for auction_doc_id in args.auction_doc_id.split(','):
+            tender_id, _, lot_id = auction_doc_id.partition('_')
+            try:
+                auction = Auction(tender_id,
+                                  worker_defaults=worker_defaults,
+                                  lot_id=lot_id or None)
+                result = plan_auction(auction, planning_procerude)
+            except SystemExit:
+                result = False
+            if result:
+                planned.append(auction_doc_id)
+            elif result is False:
+                logger.warning("Auction {} not planned".format(auction_doc_id))
+                not_planned.append(auction_doc_id)
+        if args.activate and planned:
+            activate_systemd_units(planned)
+        if not_planned:
+            sys.exit(NOT_PLANNED_EXIT_CODE)
+        return
+
     auction = Auction(args.auction_doc_id,
                       worker_defaults=worker_defaults,
                       auction_data=auction_data,
@@ -1005,25 +1198,10 @@ def main():
         auction.wait_to_end()
         SCHEDULER.shutdown()
     elif args.cmd == 'planning':
-        if args.planning_procerude:
-            planning_procerude = args.planning_procerude
-        else:
-            planning_procerude = worker_defaults.get('planning_procerude', PLANNING_FULL)
-        if planning_procerude == PLANNING_FULL:
-            auction.prepare_auction_document()
-            if not auction.debug:
-                auction.prepare_tasks(
-                    auction._auction_data["data"]['tenderID'],
-                    auction.startDate
-                )
-        elif planning_procerude == PLANNING_PARTIAL_DB:
-            auction.prepare_auction_document()
-        elif planning_procerude == PLANNING_PARTIAL_CRON:
-            auction.prepare_systemd_units()
+        if plan_auction(auction, planning_procerude) is False:
+            sys.exit(NOT_PLANNED_EXIT_CODE)
     elif args.cmd == 'announce':
         auction.post_announce()
-    elif args.cmd == 'activate':
-        auction.activate_systemd_unit()
     elif args.cmd == 'cancel':
         auction.cancel_auction()
     elif args.cmd == 'cleanup':
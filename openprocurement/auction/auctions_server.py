@@ -7,22 +7,30 @@ from collections import deque
 from Cookie import SimpleCookie
 from couchdb import Server, Session
 from datetime import datetime
+from functools import partial
 from design import sync_design, endDate_view
 from flask import Flask, render_template, request, abort, url_for, redirect, Response
 from flask.ext.assets import Environment, Bundle
 from flask_redis import Redis
+from gevent import spawn, sleep, getcurrent
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore
 from http_parser.util import IOrderedDict
 from json import dumps, loads
-from memoize import Memoizer
 from pytz import timezone as tz
+from restkit import Resource
 from restkit.conn import Connection
 from restkit.contrib.wsgi_proxy import HostProxy
 from socketpool import ConnectionPool
+from socketpool.pool import MaxConnectionsError
 from sse import Sse as PySse
 from urlparse import urlparse, urljoin
+from uuid import uuid4
+from weakref import WeakSet
 from werkzeug.exceptions import NotFound
 
-from .utils import StreamWrapper, unsuported_browser
+from .event_source import CHUNK, HUB_HEADER, HUB_SECRET_HEADER, ClientChannel
+from .utils import StreamWrapper, unsuported_browser, ProxyMappings, LRUCache
 from systemd.journal import send
 
 def start_response_decorated(start_response_decorated):
@@ -43,6 +51,118 @@ def start_response_decorated(start_response_decorated):
     return inner
 
 
+class ProxyConnectionPool(ConnectionPool):
+    """
+    ConnectionPool which keeps track of its connections for stats and
+    limits connections checked out at once to max_active: socketpool
+    max_size only caps idle connections kept for reuse
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.max_active = kwargs.pop('max_active')
+        self.acquire_timeout = kwargs.pop('acquire_timeout', 10)
+        super(ProxyConnectionPool, self).__init__(*args, **kwargs)
+        self.slots = BoundedSemaphore(self.max_active)
+        self.active = set()
+        self.closed = False
+        self.connections = WeakSet()
+        self.created = 0
+        self.requests = 0
+
+    def reclaim(self):
+        # restkit drops connections closed before release without
+        # returning them to the pool
+        for connection in list(self.active):
+            if not connection._connected:
+                self.active.discard(connection)
+                self.slots.release()
+
+    def get(self, **options):
+        self.reclaim()
+        if not self.slots.acquire(timeout=self.acquire_timeout):
+            raise MaxConnectionsError(
+                "{} connections in use".format(self.max_active))
+        try:
+            connection = super(ProxyConnectionPool, self).get(**options)
+        except:
+            self.slots.release()
+            raise
+        self.active.add(connection)
+        if connection not in self.connections:
+            self.connections.add(connection)
+            self.created += 1
+        self.requests += 1
+        return connection
+
+    def release_connection(self, connection):
+        if connection in self.active:
+            self.active.discard(connection)
+            self.slots.release()
+        if self.closed:
+            self._reap_connection(connection)
+        else:
+            super(ProxyConnectionPool, self).release_connection(connection)
+
+    def close(self):
+        """Close idle connections, checked out ones are closed on release"""
+        self.closed = True
+        self.release_all()
+        if self._reaper is not None:
+            self._reaper.kill(block=False)
+
+    def stats(self):
+        self.reclaim()
+        return {
+            'max_size': self.max_size,
+            'max_active': self.max_active,
+            'idle': self.size,
+            'in_use': len(self.active),
+            'created': self.created,
+            'requests': self.requests
+        }
+
+
+class ProxyPools(object):
+    """Connection pools per upstream backend and traffic class"""
+
+    def __init__(self, sizes, limits, max_lifetime=600., reap_delay=1,
+                 max_backends=1000, acquire_timeout=10):
+        self.sizes = sizes
+        self.limits = limits
+        self.max_lifetime = max_lifetime
+        self.reap_delay = reap_delay
+        self.acquire_timeout = acquire_timeout
+        self.pools = LRUCache(max_backends)
+
+    def evict(self):
+        """Close least recently used pool, idle pools go first"""
+        pools = self.pools.items()
+        for _, pool in pools:
+            pool.reclaim()
+        key = next((key for key, pool in pools if not pool.active), pools[0][0])
+        self.pools.pop(key).close()
+
+    def get(self, uri, traffic_class='request'):
+        key = (urlparse(uri).netloc, traffic_class)
+        pool = self.pools.get(key)
+        if pool is None:
+            if len(self.pools) >= self.pools.max_size:
+                self.evict()
+            pool = ProxyConnectionPool(
+                factory=Connection, max_size=self.sizes[traffic_class],
+                max_active=self.limits[traffic_class],
+                acquire_timeout=self.acquire_timeout,
+                max_lifetime=self.max_lifetime, reap_delay=self.reap_delay,
+                backend="gevent"
+            )
+            self.pools.set(key, pool)
+        return pool
+
+    def stats(self):
+        return [dict(pool.stats(), backend=backend, traffic_class=traffic_class)
+                for (backend, traffic_class), pool in self.pools.items()]
+
+
 class StreamProxy(HostProxy):
     def __init__(self, uri, event_sources_pool,
                  auction_doc_id="",
@@ -71,6 +191,9 @@ class StreamProxy(HostProxy):
             if value:
                 environ['HTTP_%s' % dest] = value
         environ['HTTP_X-Forwarded-Path'] = request.url
+        # Only events hubs of auctions_server talk to workers as hubs
+        for header in (HUB_HEADER, HUB_SECRET_HEADER):
+            environ.pop('HTTP_' + header.upper().replace('-', '_'), None)
         if 'HTTP_X_FORWARDED_FOR' in environ:
             environ['HTTP_X_FORWARDED_FOR'] = ", ".join(
                 [ip
@@ -91,9 +214,225 @@ class StreamProxy(HostProxy):
             auctions_server.logger.warning(
                 "Error on request to {} with msg {}".format(request.url, e)
             )
-            auctions_server.proxy_mappings.expire(str(self.auction_doc_id), 0)
+            auctions_server.proxy_mappings.expire(str(self.auction_doc_id))
             return NotFound()(environ, start_response)
 
+def forwarded_headers(environ):
+    forwarded_for = environ.get('HTTP_X_FORWARDED_FOR')
+    if forwarded_for:
+        forwarded_for = ", ".join(
+            [ip for ip in forwarded_for.split(", ") if not ip.startswith("172.")]
+        )
+    else:
+        forwarded_for = environ['REMOTE_ADDR']
+    headers = dict([
+        (key, value) for key, value in request.headers.items()
+        if key.lower() not in ('host', 'connection', 'content-length', 'accept-encoding')
+    ])
+    headers.update({
+        'X-Forwarded-For': forwarded_for,
+        'X-Forwarded-Path': request.url,
+        'X-Forwarded-Server': environ.get('HTTP_HOST', ''),
+        'X-Forwarded-Scheme': environ.get('wsgi.url_scheme', 'http')
+    })
+    return headers
+
+
+class EventsHub(object):
+    """
+    Single upstream events stream of an auction worker fanned out to all
+    clients of the auction connected to this auctions_server
+    """
+
+    def __init__(self, auction_doc_id, worker_url, pool, secret, on_close):
+        self.auction_doc_id = auction_doc_id
+        self.worker_url = worker_url
+        self.pool = pool
+        self.hub_id = uuid4().hex
+        self.headers = {HUB_HEADER: self.hub_id, HUB_SECRET_HEADER: secret}
+        self.on_close = on_close
+        self.clients = {}
+        self.connected = Event()
+        # Set once the hub is connected or closed, wakes up waiting clients
+        self.ready = Event()
+        self.closed = False
+        self.upstream = spawn(self.listen)
+
+    def resource(self):
+        return Resource(self.worker_url, pool=self.pool)
+
+    def listen(self):
+        response = None
+        try:
+            response = self.resource().get('/event_source_hub', headers=self.headers)
+            self.connected.set()
+            self.ready.set()
+            stream = response.body_stream()
+            for line in iter(stream.readline, ''):
+                line = line.strip()
+                if not line:
+                    continue
+                message = loads(line)
+                key = (message.pop('bidder_id'), message.pop('client_id'))
+                for queue in list(self.clients.get(key, ())):
+                    queue.put(message)
+        except Exception, e:
+            auctions_server.logger.warning(
+                "Events hub of auction {} failed with msg {}".format(self.auction_doc_id, e)
+            )
+        finally:
+            if response is not None:
+                response.close()
+            self.close()
+
+    def subscribe(self, bidder_id, client_id, events):
+        queue = ClientChannel()
+        queue.on_disconnect = partial(self.unsubscribe, bidder_id, client_id, queue)
+        for message in events:
+            message.pop('bidder_id', None)
+            message.pop('client_id', None)
+            queue.put(message)
+        self.clients.setdefault((bidder_id, client_id), set()).add(queue)
+        return queue
+
+    def unsubscribe(self, bidder_id, client_id, queue):
+        queues = self.clients.get((bidder_id, client_id), set())
+        if queue not in queues:
+            return
+        queues.discard(queue)
+        if not queues and not self.closed:
+            self.clients.pop((bidder_id, client_id), None)
+            spawn(self.remove_client, bidder_id, client_id)
+            if not self.clients:
+                self.close()
+
+    def remove_client(self, bidder_id, client_id):
+        try:
+            self.resource().post(
+                '/event_source_hub/remove_client',
+                payload=dumps({'bidder_id': bidder_id, 'client_id': client_id}),
+                headers=dict(self.headers, **{'Content-Type': 'application/json'})
+            )
+        except Exception, e:
+            auctions_server.logger.warning(
+                "Error on client removal from auction {} with msg {}".format(
+                    self.auction_doc_id, e)
+            )
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.set()
+        self.on_close(self)
+        # Streams are stopped and browsers reconnect to a new hub
+        for queues in self.clients.values():
+            for queue in list(queues):
+                queue.put({'event': 'StopSSE'})
+        self.clients = {}
+        if self.upstream is not getcurrent():
+            self.upstream.kill(block=False)
+
+
+class EventsHubs(object):
+    """Events hubs of auctions served by this auctions_server"""
+
+    def __init__(self, proxy_pools, secret, connect_timeout=5, refused_ttl=30,
+                 max_refused=1000):
+        self.proxy_pools = proxy_pools
+        self.secret = secret
+        self.connect_timeout = connect_timeout
+        self.refused_ttl = refused_ttl
+        self.hubs = {}
+        # Workers which refused a hub are streamed directly for a while
+        self.refused = LRUCache(max_refused)
+
+    def get(self, auction_doc_id, worker_url):
+        """Connected events hub of the auction, None if the worker refuses it"""
+        if self.refused.get(worker_url, 0) > time.time():
+            return None
+        hub = self.hubs.get(auction_doc_id)
+        if hub is not None and hub.worker_url != worker_url:
+            hub.close()
+            hub = None
+        if hub is None:
+            hub = EventsHub(auction_doc_id, worker_url,
+                            self.proxy_pools.get(worker_url, 'sse'),
+                            self.secret, on_close=self.remove)
+            self.hubs[auction_doc_id] = hub
+        hub.ready.wait(timeout=self.connect_timeout)
+        if hub.connected.is_set() and not hub.closed:
+            return hub
+
+    def remove(self, hub):
+        if self.hubs.get(hub.auction_doc_id) is hub:
+            del self.hubs[hub.auction_doc_id]
+        if not hub.connected.is_set():
+            self.refused.set(hub.worker_url, time.time() + self.refused_ttl)
+
+
+class EventsHubStream(object):
+    """Registers a client at the worker and streams its events from the hub"""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def __call__(self, environ, start_response):
+        headers = forwarded_headers(environ)
+        headers.update(self.hub.headers)
+        try:
+            response = self.hub.resource().get('/event_source', headers=headers)
+            body = response.body_string()
+        except Exception, e:
+            auctions_server.logger.warning(
+                "Error on request to {} with msg {}".format(request.url, e)
+            )
+            auctions_server.proxy_mappings.expire(str(self.hub.auction_doc_id))
+            return NotFound()(environ, start_response)
+        response_headers = [
+            (key, value) for key, value in response.headerslist
+            if key.lower() in ('set-cookie', 'cache-control')
+        ]
+        if not response.headers.get('Content-Type', '').startswith('application/json'):
+            start_response_decorated(start_response)(response.status, response_headers + [
+                ('Content-Type', response.headers.get('Content-Type', 'text/event-stream'))
+            ])
+            return [body]
+        registration = loads(body)
+        queue = self.hub.subscribe(registration['bidder_id'], registration['client_id'],
+                                   registration['events'])
+        start_response_decorated(start_response)('200 OK', response_headers + [
+            ('Content-Type', 'text/event-stream')
+        ])
+        return self.stream(registration, queue)
+
+    def stream(self, registration, queue):
+        if registration['timeout']:
+            timeout = spawn(self.stop_after, queue, registration['timeout'])
+        else:
+            timeout = None
+        sse = PySse()
+        try:
+            yield CHUNK
+            for data in sse:
+                yield data.encode('u8')
+            while True:
+                message = queue.get()
+                if message['event'] == 'StopSSE':
+                    return
+                sse.add_message(message['event'], dumps(message['data']))
+                for data in sse:
+                    yield data.encode('u8')
+        finally:
+            if timeout is not None:
+                timeout.kill(block=False)
+            self.hub.unsubscribe(registration['bidder_id'], registration['client_id'], queue)
+
+    def stop_after(self, queue, timeout):
+        sleep(timeout)
+        queue.put({'event': 'StopSSE'})
+
+
 auctions_server = Flask(
     __name__,
     static_url_path='',
@@ -231,13 +570,17 @@ def archive_auction_list_index():
                        methods=['GET', 'POST'])
 def auctions_proxy(auction_doc_id, path):
     auctions_server.logger.debug('Auction_doc_id: {}'.format(auction_doc_id))
-    proxy_path = auctions_server.proxy_mappings.get(
-        str(auction_doc_id),
-        auctions_server.redis.get,
-        (str(auction_doc_id), ), max_age=60
-    )
+    proxy_path = auctions_server.proxy_mappings.get(str(auction_doc_id))
     auctions_server.logger.debug('Proxy path: {}'.format(proxy_path))
-    if proxy_path:
+    hub = None
+    if proxy_path and path == 'event_source' and auctions_server.config['event_source_hub']:
+        # Falls back to the plain proxy while the worker refuses the hub
+        hub = auctions_server.events_hubs.get(str(auction_doc_id), proxy_path)
+    if proxy_path and path.startswith('event_source_hub'):
+        return abort(404)
+    elif hub is not None:
+        return EventsHubStream(hub)
+    elif proxy_path:
         request.environ['PATH_INFO'] = '/' + path
         auctions_server.logger.debug('Start proxy to path: {}'.format(path))
         return StreamProxy(
@@ -245,7 +588,9 @@ def auctions_proxy(auction_doc_id, path):
             auction_doc_id=str(auction_doc_id),
             event_sources_pool=auctions_server.event_sources_pool,
             event_source_connection_limit=auctions_server.config['event_source_connection_limit'],
-            pool=auctions_server.proxy_connection_pool,
+            pool=auctions_server.proxy_pools.get(
+                proxy_path, 'sse' if path == 'event_source' else 'request'
+            ),
             backend="gevent"
         )
     elif path == 'login' and auction_doc_id in auctions_server.db:
@@ -265,6 +610,21 @@ def auctions_proxy(auction_doc_id, path):
     return abort(404)
 
 
+def internal_request():
+    """Request made on this host directly, not through a frontend proxy"""
+    return request.environ.get('REMOTE_ADDR') in auctions_server.config['INTERNAL_ADDRS'] \
+        and 'X-Forwarded-For' not in request.headers \
+        and 'X-Forwarded-Path' not in request.headers
+
+
+@auctions_server.route('/proxy_pools')
+def proxy_pools_stats():
+    if not internal_request():
+        return abort(404)
+    return Response(dumps(auctions_server.proxy_pools.stats()),
+                    mimetype='application/json')
+
+
 @auctions_server.route('/get_current_server_time')
 def auctions_server_current_server_time():
     response = Response(datetime.now(auctions_server.config['TIMEZONE']).isoformat())
@@ -277,7 +637,7 @@ def couch_server_proxy(path):
     return StreamProxy(
         auctions_server.config['PROXY_COUCH_URL'],
         auctions_server.event_sources_pool,
-        pool=auctions_server.proxy_connection_pool,
+        pool=auctions_server.proxy_pools.get(auctions_server.config['PROXY_COUCH_URL']),
         backend="gevent"
     )
 
@@ -287,7 +647,7 @@ def auth_couch_server_proxy(path):
     return StreamProxy(
         auctions_server.config['PROXY_COUCH_URL'],
         auctions_server.event_sources_pool,
-        pool=auctions_server.proxy_connection_pool,
+        pool=auctions_server.proxy_pools.get(auctions_server.config['PROXY_COUCH_URL']),
         backend="gevent"
     )
 
@@ -303,7 +663,18 @@ def make_auctions_app(global_conf,
                       preferred_url_scheme='http',
                       debug=False,
                       auto_build=False,
-                      event_source_connection_limit=1000
+                      event_source_connection_limit=1000,
+                      proxy_pool_size=20,
+                      sse_proxy_pool_size=5,
+                      proxy_max_connections=100,
+                      sse_proxy_max_connections=1000,
+                      proxy_acquire_timeout=10,
+                      proxy_keepalive=600,
+                      proxy_reap_delay=1,
+                      proxy_max_backends=1000,
+                      event_source_hub=True,
+                      event_source_hub_secret='',
+                      internal_addrs='127.0.0.1 ::1'
                       ):
     """
     [app:main]
@@ -313,12 +684,29 @@ def make_auctions_app(global_conf,
     internal_couch_url = http://localhost:9011/
     auctions_db = auction
     timezone = Europe/Kiev
+    proxy_pool_size = 20
+    sse_proxy_pool_size = 5
+    proxy_max_connections = 100
+    sse_proxy_max_connections = 1000
+    proxy_keepalive = 600
+    event_source_hub = true
+    event_source_hub_secret = secret shared with EVENT_SOURCE_HUB_SECRET of workers
+    internal_addrs = 127.0.0.1 ::1
     """
-    auctions_server.proxy_connection_pool = ConnectionPool(
-        factory=Connection, max_size=20, backend="gevent"
+    auctions_server.proxy_pools = ProxyPools(
+        {'request': int(proxy_pool_size), 'sse': int(sse_proxy_pool_size)},
+        {'request': int(proxy_max_connections), 'sse': int(sse_proxy_max_connections)},
+        max_lifetime=float(proxy_keepalive),
+        reap_delay=float(proxy_reap_delay),
+        max_backends=int(proxy_max_backends),
+        acquire_timeout=float(proxy_acquire_timeout)
     )
-    auctions_server.proxy_mappings = Memoizer({})
+    auctions_server.config['INTERNAL_ADDRS'] = set(internal_addrs.split())
     auctions_server.event_sources_pool = deque([])
+    auctions_server.events_hubs = EventsHubs(auctions_server.proxy_pools, event_source_hub_secret)
+    # Workers accept hubs only with the shared secret
+    auctions_server.config['event_source_hub'] = \
+        str(event_source_hub).lower() in ('true', '1', 'yes', 'on') and bool(event_source_hub_secret)
     auctions_server.config['PREFERRED_URL_SCHEME'] = preferred_url_scheme
     auctions_server.config['REDIS_URL'] = redis_url
     auctions_server.config['event_source_connection_limit'] = int(event_source_connection_limit)
@@ -353,6 +741,7 @@ def make_auctions_app(global_conf,
     auctions_server.config['COUCH_DB'] = auctions_db
     auctions_server.config['TIMEZONE'] = tz(timezone)
     auctions_server.redis = Redis(auctions_server)
+    auctions_server.proxy_mappings = ProxyMappings(auctions_server.redis)
     auctions_server.couch_server = Server(
         auctions_server.config.get('INT_COUCH_URL'),
         session=Session(retry_delays=range(10))
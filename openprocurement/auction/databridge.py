@@ -12,16 +12,23 @@ import logging
 import logging.config
 import os
 import argparse
-import iso8601
+import json
 
+from collections import defaultdict, deque
+from copy import deepcopy
 from datetime import datetime
+from heapq import heappush, heappop
+from itertools import count
 from subprocess import check_call
 from time import sleep, mktime, time
 from urlparse import urljoin
 
 from apscheduler.schedulers.gevent import GeventScheduler
+from gevent import spawn, spawn_later
+from gevent.lock import Semaphore
+from gevent.pool import Pool
 from gevent.queue import Queue, Empty
-from gevent.subprocess import call, check_call
+from gevent.subprocess import call, check_call, CalledProcessError
 
 from couchdb import Database, Session
 from dateutil.tz import tzlocal
@@ -45,20 +52,54 @@ from systemd_msgs_ids import (
     DATA_BRIDGE_RE_PLANNING_START_BRIDGE,
     DATA_BRIDGE_RE_PLANNING_TENDER_ALREADY_PLANNED,
     DATA_BRIDGE_RE_PLANNING_LOT_ALREADY_PLANNED,
-    DATA_BRIDGE_RE_PLANNING_FINISHED
+    DATA_BRIDGE_RE_PLANNING_FINISHED,
+    DATA_BRIDGE_RE_PLANNING_PROGRESS
 )
 from yaml import load
 from .design import endDate_view, startDate_view, PreAnnounce_view
-from .utils import do_until_success, generate_request_id
+from .utils import (
+    do_until_success, generate_request_id, parse_date, NOT_PLANNED_EXIT_CODE
+)
 
 SIMPLE_AUCTION_TYPE = 0
 SINGLE_LOT_AUCTION_TYPE = 1
 
 MULTILOT_AUCTION_ID = "{0[id]}_{1[id]}"  # {TENDER_ID}_{LOT_ID}
+DEFAULT_STATE_FILE = "~/.auctions_data_bridge_{}.json"  # {AUCTIONS_DB}
 
 logger = logging.getLogger(__name__)
 
 
+class FeedCursor(object):
+
+    """
+    Feed position which is safe to resume from: it moves past a feed item
+    only when all auctions selected from it and from previous items are
+    planned, ``on_advance`` is called with every new position
+    """
+
+    def __init__(self, on_advance):
+        self.on_advance = on_advance
+        self.pending = deque()
+
+    def hold(self, position):
+        """Start item which ends at position, returns entry to release it"""
+        entry = [position, 1]
+        self.pending.append(entry)
+        return entry
+
+    def acquire(self, entry):
+        entry[1] += 1
+
+    def release(self, entry):
+        entry[1] -= 1
+        position = None
+        while self.pending and self.pending[0][1] <= 0:
+            position = self.pending.popleft()[0]
+        if position is not None:
+            self.on_advance(position)
+
+
 class AuctionsDataBridge(object):
 
     """Auctions Data Bridge"""
@@ -66,8 +107,10 @@ class AuctionsDataBridge(object):
     def __init__(self, config, activate=False):
         super(AuctionsDataBridge, self).__init__()
         self.config = config
-        self.tenders_ids_list = []
+        self.tenders_ids_list = set()
+        self.in_process = False
         self.activate = activate
+        self.re_planning = False
         self.client = ApiClient(
             '',
             host_url=self.config_get('tenders_api_server'),
@@ -85,6 +128,31 @@ class AuctionsDataBridge(object):
         )
         self.db = Database(self.couch_url,
                            session=Session(retry_delays=range(10)))
+        self.state_file = os.path.expanduser(
+            self.config_get('state_file') or
+            DEFAULT_STATE_FILE.format(self.config_get('auctions_db'))
+        )
+        self.state = self.load_state()
+        self.state_save_interval = self.config_get('state_save_interval')
+        if self.state_save_interval is None:
+            self.state_save_interval = 5
+        self.state_saved_at = 0
+        self.state_saver = None
+        self.feed_cursor = None
+        self.planned_tenders = {}
+        self.unplanned = set()
+        self.timings = defaultdict(lambda: [0, 0.0, None])
+        self.planning_heap = []
+        # Feed consumers wait while the heap is full, so a long feed is
+        # not pulled into memory faster than it is planned
+        self.planning_heap_slots = Semaphore(self.config_get('planning_heap_size') or 1000)
+        self.planning_counter = count()
+        self.planning_dispatcher = None
+
+        self.planning_pool = Pool(self.config_get('planning_pool_size') or 10)
+        self.planning_batch_size = self.config_get('planning_batch_size') or 10
+        if self.config_get('in_process_planning'):
+            self.prepare_in_process_planning()
 
         if self.activate:
             self.queue = Queue()
@@ -96,6 +164,56 @@ class AuctionsDataBridge(object):
     def config_get(self, name):
         return self.config.get('main').get(name)
 
+    def load_state(self):
+        if not os.path.isfile(self.state_file):
+            return {}
+        try:
+            with open(self.state_file) as state_file:
+                return json.load(state_file)
+        except (IOError, ValueError), e:
+            logger.warning("Can't load bridge state from {}: {}".format(
+                self.state_file, e))
+            return {}
+
+    def save_state(self, **state):
+        """Update bridge state, the file is written at most once per state_save_interval"""
+        self.state.update(state)
+        if self.state_saver is None:
+            delay = max(self.state_saved_at + self.state_save_interval - time(), 0)
+            self.state_saver = spawn_later(delay, self.write_state)
+
+    def write_state(self):
+        self.state_saver = None
+        self.state_saved_at = time()
+        try:
+            with open(self.state_file + '.tmp', 'w') as state_file:
+                json.dump(self.state, state_file)
+            os.rename(self.state_file + '.tmp', self.state_file)
+        except (IOError, OSError), e:
+            logger.warning("Can't save bridge state to {}: {}".format(
+                self.state_file, e))
+
+    def prepare_in_process_planning(self):
+        try:
+            from .auction_worker import (
+                Auction, plan_auction, activate_systemd_units, PLANNING_FULL
+            )
+        except ImportError, e:
+            logger.warning("Can't import auction worker ({}), "
+                           "fallback to subprocess planning".format(e))
+            return
+        self.auction_worker = {
+            'Auction': Auction,
+            'plan_auction': plan_auction,
+            'activate_systemd_units': activate_systemd_units
+        }
+        with open(self.config_get('auction_worker_config')) as config_file:
+            self.worker_defaults = json.load(config_file)
+        self.planning_procerude = self.worker_defaults.get(
+            'planning_procerude', PLANNING_FULL
+        )
+        self.in_process = True
+
     def run_systemd_cmds(self):
         auctions = []
         logger.info('Start systemd units activator')
@@ -110,35 +228,112 @@ class AuctionsDataBridge(object):
                 check_call,
                 (['/usr/bin/systemctl', '--user', 'daemon-reload'],)
             )
-            for planning_data in auctions:
-                if len(planning_data) == 1:
-                    logger.info('Tender {0} selected for activate'.format(*planning_data))
-                    self.start_auction_worker_cmd('activate', planning_data[0])
-                elif len(planning_data) == 2:
-                    logger.info('Lot {1} of tender {0} selected for activate'.format(*planning_data))
-                    self.start_auction_worker_cmd('activate', planning_data[0], lot_id=planning_data[1])
+            auctions = sorted(set(auctions))
+            logger.info('Auctions {} selected for activate'.format(
+                ', '.join(auctions)))
+            self.start_auction_worker_cmd('activate', ','.join(auctions))
         else:
             logger.info('No auctions to activate')
 
 
+    def get_start_date_key(self, auction_period):
+        start_date = parse_date(auction_period['startDate'], self.tz)
+        return start_date, (mktime(start_date.timetuple()) + start_date.microsecond / 1E6) * 1000
+
+    def lookup_auctions(self, tenders_list):
+        """
+        Resolve all auctions of a feed page with one request per view:
+        returns (start date key, auction id) pairs already planned,
+        ids of auctions waiting for announce and ids of future auctions
+        """
+        start_keys = set()
+        need_pre_announce = need_future = False
+        for item in tenders_list:
+            if item['status'] == "active.auction":
+                if 'auctionPeriod' in item and 'startDate' in item['auctionPeriod'] \
+                        and 'endDate' not in item['auctionPeriod']:
+                    start_keys.add(self.get_start_date_key(item['auctionPeriod'])[1])
+                elif 'lots' in item:
+                    for lot in item['lots']:
+                        if lot["status"] == "active" and 'auctionPeriod' in lot \
+                                and 'startDate' in lot['auctionPeriod'] and 'endDate' not in lot['auctionPeriod']:
+                            start_keys.add(self.get_start_date_key(lot['auctionPeriod'])[1])
+            if item['status'] == "active.qualification" and 'lots' in item:
+                need_pre_announce = True
+            if item['status'] == "cancelled":
+                need_future = True
+        planned = set()
+        if start_keys:
+            planned = set((row.key, row.id)
+                          for row in startDate_view(self.db, keys=sorted(start_keys)))
+        pre_announce = set()
+        if need_pre_announce:
+            pre_announce = set(row.id for row in PreAnnounce_view(self.db))
+        future_auctions = set()
+        if need_future:
+            future_auctions = set(row.id for row in endDate_view(self.db, startkey=time() * 1000))
+        return planned, pre_announce, future_auctions
+
+    def add_timing(self, stage, seconds):
+        timing = self.timings[stage]
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = seconds if timing[2] is None else min(timing[2], seconds)
+
+    def log_timings(self):
+        logger.info("Stages timings: {}".format(", ".join(
+            "{}: {} in {:.3f}s (avg {:.3f}s, min {:.3f}s)".format(
+                stage, number, total, total / number, minimum)
+            for stage, (number, total, minimum) in sorted(self.timings.items())
+        )))
+        self.timings.clear()
+
+    def fetch_tenders_pages(self, pages):
+        """
+        Producer of (tenders_list, params, offset, error) items: the page,
+        client params of its request and the offset after it, tenders_list
+        is None at the end
+        """
+        try:
+            while True:
+                request_id = generate_request_id(prefix=b'data-bridge-req-')
+                self.client.headers.update({'X-Client-Request-ID': request_id})
+                params = dict(self.client.params)
+                started_at = time()
+                tenders_list = list(self.client.get_tenders())
+                self.add_timing('fetch', time() - started_at)
+                if not tenders_list:
+                    break
+                pages.put((tenders_list, params, self.client.params.get('offset'), None))
+        except Exception, e:
+            pages.put((None, None, None, e))
+        else:
+            pages.put((None, None, None, None))
+
     def get_teders_list(self, re_planning=False):
-        while True:
-            request_id = generate_request_id(prefix=b'data-bridge-req-')
-            self.client.headers.update({'X-Client-Request-ID': request_id})
-            tenders_list = list(self.client.get_tenders())
-            if tenders_list:
-                logger.info("Client params: {}".format(self.client.params))
+        # Next pages are fetched while the current one is processed,
+        # the bounded queue stops the producer when planning falls behind
+        pages = Queue(maxsize=self.config_get('feed_prefetch_pages') or 2)
+        producer = spawn(self.fetch_tenders_pages, pages)
+        try:
+            while True:
+                started_at = time()
+                tenders_list, params, offset, error = pages.get()
+                self.add_timing('wait', time() - started_at)
+                if error is not None:
+                    raise error
+                if tenders_list is None:
+                    break
+                started_at = time()
+                logger.info("Client params: {}".format(params))
+                page = self.feed_cursor.hold(offset)
+                planned, pre_announce, future_auctions = self.lookup_auctions(tenders_list)
                 for item in tenders_list:
                     if item['status'] == "active.auction":
                         if 'auctionPeriod' in item and 'startDate' in item['auctionPeriod'] \
                                 and 'endDate' not in item['auctionPeriod']:
 
-                            start_date = iso8601.parse_date(item['auctionPeriod']['startDate'])
-                            start_date = start_date.astimezone(self.tz)
-                            auctions_start_in_date = startDate_view(
-                                self.db,
-                                key=(mktime(start_date.timetuple()) + start_date.microsecond / 1E6) * 1000
-                            )
+                            start_date, start_key = self.get_start_date_key(item['auctionPeriod'])
                             if datetime.now(self.tz) > start_date:
                                 logger.info("Tender {} start date in past. Skip it for planning".format(item['id']),
                                             extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_TENDER_SKIP})
@@ -147,21 +342,17 @@ class AuctionsDataBridge(object):
                                 logger.info("Tender {} already planned while replanning".format(item['id']),
                                             extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_TENDER_ALREADY_PLANNED})
                                 continue
-                            elif not re_planning and [row.id for row in auctions_start_in_date.rows if row.id == item['id']]:
+                            elif not re_planning and (start_key, item['id']) in planned:
                                 logger.info("Tender {} already planned on same date".format(item['id']),
                                             extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_TENDER_ALREADY_PLANNED})
                                 continue
-                            yield (str(item['id']), )
+                            self.feed_cursor.acquire(page)
+                            yield start_date, (str(item['id']), ), page
                         elif 'lots' in item:
                             for lot in item['lots']:
                                 if lot["status"] == "active" and 'auctionPeriod' in lot \
                                         and 'startDate' in lot['auctionPeriod'] and 'endDate' not in lot['auctionPeriod']:
-                                    start_date = iso8601.parse_date(lot['auctionPeriod']['startDate'])
-                                    start_date = start_date.astimezone(self.tz)
-                                    auctions_start_in_date = startDate_view(
-                                        self.db,
-                                        key=(mktime(start_date.timetuple()) + start_date.microsecond / 1E6) * 1000
-                                    )
+                                    start_date, start_key = self.get_start_date_key(lot['auctionPeriod'])
                                     if datetime.now(self.tz) > start_date:
                                         logger.info(
                                             "Start date for lot {} in tender {} is in past. Skip it for planning".format(
@@ -174,36 +365,38 @@ class AuctionsDataBridge(object):
                                         logger.info("Tender {} already planned while replanning".format(auction_id),
                                                     extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_LOT_ALREADY_PLANNED})
                                         continue
-                                    elif not re_planning and [row.id for row in auctions_start_in_date.rows if row.id == auction_id]:
+                                    elif not re_planning and (start_key, auction_id) in planned:
                                         logger.info("Tender {} already planned on same date".format(auction_id),
                                                     extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_LOT_ALREADY_PLANNED})
                                         continue
-                                    yield (str(item["id"]), str(lot["id"]), )
+                                    self.feed_cursor.acquire(page)
+                                    yield start_date, (str(item["id"]), str(lot["id"]), ), page
                     if item['status'] == "active.qualification" and 'lots' in item:
                         for lot in item['lots']:
                             if lot["status"] == "active":
-                                is_pre_announce = PreAnnounce_view(self.db)
                                 auction_id = MULTILOT_AUCTION_ID.format(item, lot)
-                                if [row.id for row in is_pre_announce.rows if row.id == auction_id]:
-                                    self.start_auction_worker_cmd('announce', item['id'], lot_id=lot['id'],)
+                                if auction_id in pre_announce:
+                                    self.start_auction_worker_cmd('announce', item['id'], lot_id=lot['id'],
+                                                                   feed_entry=page)
                     if item['status'] == "cancelled":
-                        future_auctions = endDate_view(
-                            self.db, startkey=time() * 1000
-                        )
                         if 'lots' in item:
                             for lot in item['lots']:
                                 auction_id = MULTILOT_AUCTION_ID.format(item, lot)
-                                if auction_id in [i.id for i in future_auctions]:
+                                if auction_id in future_auctions:
                                     logger.info('Tender {0} selected for cancellation'.format(item['id']))
-                                    self.start_auction_worker_cmd('cancel', item['id'], lot_id=lot['id'])
+                                    self.start_auction_worker_cmd('cancel', item['id'], lot_id=lot['id'],
+                                                                   feed_entry=page)
                         else:
-                            if item["id"] in [i.id for i in future_auctions]:
+                            if item["id"] in future_auctions:
                                 logger.info('Tender {0} selected for cancellation'.format(item['id']))
-                                self.start_auction_worker_cmd('cancel', item["id"])
-            else:
-                break
-
-    def start_auction_worker_cmd(self, cmd, tender_id, with_api_version=None, lot_id=None):
+                                self.start_auction_worker_cmd('cancel', item["id"], feed_entry=page)
+                self.feed_cursor.release(page)
+                self.add_timing('process', time() - started_at)
+        finally:
+            producer.kill()
+        self.log_timings()
+
+    def auction_worker_params(self, cmd, tender_id, with_api_version=None, lot_id=None):
         params = [self.config_get('auction_worker'),
                   cmd, tender_id,
                   self.config_get('auction_worker_config')]
@@ -212,64 +405,258 @@ class AuctionsDataBridge(object):
 
         if with_api_version:
             params += ['--with_api_version', with_api_version]
+        if cmd == 'planning' and self.activate:
+            # The worker activates units of the auctions it planned, so
+            # auctions without units never reach the batched systemctl call
+            params += ['--activate']
+        return params
+
+    def call_auction_worker_process(self, params):
+        """Run auction worker command in subprocess"""
+        code = call(params)
+        if code not in (0, NOT_PLANNED_EXIT_CODE):
+            raise CalledProcessError(code, params)
+        return code
+
+    def call_auction_worker(self, cmd, tender_id, with_api_version=None, lot_id=None):
+        """Run auction worker command in current process"""
+        if cmd == 'activate':
+            return self.auction_worker['activate_systemd_units'](
+                tender_id.split(','), daemon_reload=False
+            )
+        worker_defaults = deepcopy(self.worker_defaults)
+        if with_api_version:
+            worker_defaults['TENDERS_API_VERSION'] = with_api_version
+        try:
+            auction = self.auction_worker['Auction'](
+                tender_id, worker_defaults=worker_defaults, lot_id=lot_id
+            )
+            if cmd == 'planning':
+                if self.auction_worker['plan_auction'](
+                        auction, self.planning_procerude,
+                        cmd=self.auction_worker_params('run', tender_id,
+                                                       with_api_version, lot_id)
+                ) is False:
+                    return NOT_PLANNED_EXIT_CODE
+            elif cmd == 'announce':
+                auction.post_announce()
+            elif cmd == 'cancel':
+                auction.cancel_auction()
+        except SystemExit, e:
+            # Same result as exit code of auction_worker subprocess, where
+            # a bare sys.exit() exits with 0
+            if e.code == NOT_PLANNED_EXIT_CODE:
+                return e.code
+            if e.code:
+                raise RuntimeError("Auction worker exit with code {}".format(e.code))
+        return 0
+
+    def run_auction_worker_cmd(self, cmd, tender_id, with_api_version=None, lot_id=None,
+                               start_date=None):
+        started_at = time()
+        if self.in_process:
+            result = do_until_success(
+                self.call_auction_worker,
+                args=(cmd, tender_id),
+                kw={'with_api_version': with_api_version, 'lot_id': lot_id}
+            )
+        else:
+            result = do_until_success(
+                self.call_auction_worker_process,
+                args=(self.auction_worker_params(cmd, tender_id,
+                                                 with_api_version, lot_id),),
+            )
 
-        result = do_until_success(
-            check_call,
-            args=(params,),
-        )
-
+        self.add_timing(cmd, time() - started_at)
         logger.info("Auction planning command result: {}".format(result),
                     extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_PROCESS})
-        if self.activate and cmd == 'planning':
-            if lot_id:
-                self.queue.put((tender_id, lot_id,))
-            else:
-                self.queue.put((tender_id, ))
+        if cmd != 'planning':
+            return result
+        auction_ids = tender_id.split(',')
+        if lot_id:
+            auction_ids = [MULTILOT_AUCTION_ID.format({'id': tender_id}, {'id': lot_id})]
+        if result == NOT_PLANNED_EXIT_CODE:
+            logger.warning("Auctions {} not planned".format(', '.join(auction_ids)))
+        if start_date is not None:
+            slack = (start_date - datetime.now(self.tz)).total_seconds()
+            self.add_timing('slack', slack)
+            logger.info("Auctions {} planned {:.0f}s before start".format(
+                ', '.join(auction_ids), slack))
+        if self.activate and self.in_process and result == 0:
+            for auction_id in auction_ids:
+                self.queue.put(auction_id)
+        return result
+
+    def run_planning(self, auctions):
+        """
+        Plan (start_date, _, tender_id, with_api_version, lot_id, feed_entry)
+        items with one worker call, then release their feed cursor entries
+        """
+        start_date, _, tender_id, with_api_version, lot_id, _ = auctions[0]
+        auction_ids = [MULTILOT_AUCTION_ID.format({'id': item[2]}, {'id': item[4]}) if item[4] else item[2]
+                       for item in auctions]
+        if len(auctions) > 1:
+            tender_id = ','.join(auction_ids)
+            lot_id = None
+        result = self.run_auction_worker_cmd('planning', tender_id,
+                                             with_api_version=with_api_version,
+                                             lot_id=lot_id, start_date=start_date)
+        if result is not None:
+            self.unplanned.difference_update(auction_ids)
+        self.release_feed_entries([item[5] for item in auctions if item[5] is not None],
+                                  result, 'planning', tender_id)
+        if result is not None and not self.unplanned and self.state_saver is not None:
+            # Planning heap is drained, save its final position right away
+            self.state_saver.kill()
+            self.write_state()
+        return result
+
+    def release_feed_entries(self, feed_entries, result, cmd, tender_id):
+        """
+        Release feed cursor entries of a finished worker command. A command
+        which still failed keeps the saved feed position before it, so it
+        is repeated after restart
+        """
+        if result is None:
+            if feed_entries:
+                logger.error("Auction worker {} of {} failed, feed position is kept "
+                             "before it until restart".format(cmd, tender_id))
+            return
+        for feed_entry in feed_entries:
+            self.feed_cursor.release(feed_entry)
+
+    def run_feed_worker_cmd(self, feed_entries, cmd, tender_id, **kwargs):
+        result = self.run_auction_worker_cmd(cmd, tender_id, **kwargs)
+        self.release_feed_entries(feed_entries, result, cmd, tender_id)
+        return result
+
+    def planning_batches(self, auctions):
+        """
+        Split start date ordered auctions into worker calls, a worker
+        subprocess plans a batch of auctions with the same api version
+        """
+        batch_size = 1 if self.in_process else self.planning_batch_size
+        batch = []
+        for item in auctions:
+            if batch and (len(batch) == batch_size or item[3] != batch[0][3]):
+                yield batch
+                batch = []
+            batch.append(item)
+        if batch:
+            yield batch
+
+    def start_auction_worker_cmd(self, cmd, tender_id, with_api_version=None, lot_id=None,
+                                 feed_entry=None):
+        if cmd != 'activate':
+            feed_entries = ()
+            if feed_entry is not None:
+                self.feed_cursor.acquire(feed_entry)
+                feed_entries = (feed_entry,)
+            self.planning_pool.spawn(self.run_feed_worker_cmd, feed_entries, cmd, tender_id,
+                                     with_api_version=with_api_version, lot_id=lot_id)
+        else:
+            self.run_auction_worker_cmd(cmd, tender_id,
+                                        with_api_version=with_api_version, lot_id=lot_id)
+
+    def schedule_planning(self, start_date, tender_id, with_api_version=None, lot_id=None,
+                          feed_entry=None):
+        """
+        Buffer auction for planning, auctions which start sooner are planned
+        first. Acquired feed_entry of the feed cursor is released once the
+        auction is planned. Blocks while planning_heap_size auctions wait
+        """
+        self.planning_heap_slots.acquire()
+        self.unplanned.add(MULTILOT_AUCTION_ID.format({'id': tender_id}, {'id': lot_id})
+                           if lot_id else tender_id)
+        heappush(self.planning_heap, (start_date, next(self.planning_counter),
+                                      tender_id, with_api_version, lot_id, feed_entry))
+        if self.planning_dispatcher is None or self.planning_dispatcher.dead:
+            self.planning_dispatcher = spawn(self.dispatch_planning)
+
+    def dispatch_planning(self):
+        while self.planning_heap:
+            self.planning_pool.wait_available()
+            batch = [heappop(self.planning_heap)]
+            while not self.in_process and self.planning_heap and \
+                    len(batch) < self.planning_batch_size and \
+                    self.planning_heap[0][3] == batch[0][3]:
+                batch.append(heappop(self.planning_heap))
+            for _ in batch:
+                self.planning_heap_slots.release()
+            self.planning_pool.spawn(self.run_planning, batch)
 
     def planning_with_couch(self):
         logger.info('Start Auctions Bridge with feed to couchdb',
                     extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_COUCH_FEED})
         logger.info('Start data sync...',
                     extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_COUCH_DATA_SYNC})
-        self.planned_tenders = {}
-        self.last_seq_id = 0
+        self.planned_tenders = dict(self.state.get('planned_tenders', {}))
+        self.last_seq_id = self.state.get('last_seq_id', 0)
+        self.feed_cursor = FeedCursor(self.save_seq_state)
+        if self.last_seq_id:
+            logger.info('Resume couchdb feed since {}'.format(self.last_seq_id))
         while True:
             do_until_success(self.handle_continuous_feed)
 
+    def save_seq_state(self, last_seq_id):
+        """Save couchdb feed position with auctions planned before it"""
+        now = datetime.now(self.tz)
+        for auction_id, start_date in self.planned_tenders.items():
+            if parse_date(start_date, self.tz) < now:
+                del self.planned_tenders[auction_id]
+        self.save_state(last_seq_id=last_seq_id, planned_tenders=dict(
+            (auction_id, start_date)
+            for auction_id, start_date in self.planned_tenders.items()
+            if auction_id not in self.unplanned
+        ))
+
     def handle_continuous_feed(self):
         change = self.db.changes(feed='continuous', filter="auctions/by_startDate",
                                  since=self.last_seq_id, include_docs=True)
         for auction_item in change:
             if 'id' in auction_item:
-                start_date = auction_item['doc']['stages'][0]['start']
-                if auction_item['doc'].get("current_stage", "") == -100:
-                    continue
-
-                if auction_item['doc'].get("mode", "") == "test":
-                    logger.info('Skiped test auction {}'.format(auction_item['id']),
-                                extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_SKIPED_TEST})
-                    continue
-
-                if auction_item['id'] in self.planned_tenders and \
-                        self.planned_tenders[auction_item['id']] == start_date:
-                    logger.debug('Tender {} filtered'.format(auction_item['id']))
-                    continue
-                logger.info('Tender {} selected for planning'.format(auction_item['id']),
-                            extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_SELECT_TENDER})
-
-                if "_" in auction_item['id']:
-                    tender_id, lot_id = auction_item['id'].split("_")
-                else:
-                    tender_id = auction_item['id']
-                    lot_id = None
-
-                self.start_auction_worker_cmd('planning', tender_id, lot_id=lot_id,
-                    with_api_version=auction_item['doc'].get('TENDERS_API_VERSION', None)
-                )
-
-                self.planned_tenders[auction_item['id']] = start_date
+                self.last_seq_id = auction_item['seq']
+                feed_entry = self.feed_cursor.hold(self.last_seq_id)
+                try:
+                    self.handle_change(auction_item, feed_entry)
+                finally:
+                    self.feed_cursor.release(feed_entry)
             elif 'last_seq' in auction_item:
                 self.last_seq_id = auction_item['last_seq']
+                self.feed_cursor.release(self.feed_cursor.hold(self.last_seq_id))
+
+        logger.info('Resume data sync...',
+                    extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_DATA_SYNC_RESUME})
+
+    def handle_change(self, auction_item, feed_entry):
+        start_date = auction_item['doc']['stages'][0]['start']
+        if auction_item['doc'].get("current_stage", "") == -100:
+            return
+
+        if auction_item['doc'].get("mode", "") == "test":
+            logger.info('Skiped test auction {}'.format(auction_item['id']),
+                        extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_SKIPED_TEST})
+            return
+
+        if auction_item['id'] in self.planned_tenders and \
+                self.planned_tenders[auction_item['id']] == start_date:
+            logger.debug('Tender {} filtered'.format(auction_item['id']))
+            return
+        logger.info('Tender {} selected for planning'.format(auction_item['id']),
+                    extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_SELECT_TENDER})
+
+        if "_" in auction_item['id']:
+            tender_id, lot_id = auction_item['id'].split("_")
+        else:
+            tender_id = auction_item['id']
+            lot_id = None
+
+        self.feed_cursor.acquire(feed_entry)
+        self.schedule_planning(parse_date(start_date, self.tz), tender_id, lot_id=lot_id,
+            with_api_version=auction_item['doc'].get('TENDERS_API_VERSION', None),
+            feed_entry=feed_entry
+        )
+        self.planned_tenders[auction_item['id']] = start_date
 
         logger.info('Resume data sync...',
                     extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_DATA_SYNC_RESUME})
@@ -279,14 +666,19 @@ class AuctionsDataBridge(object):
                     extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_START_BRIDGE})
         logger.info('Start data sync...',
                     extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_DATA_SYNC})
+        if self.state.get('offset'):
+            logger.info('Resume tenders feed from offset {}'.format(self.state['offset']))
+            self.client.params['offset'] = self.state['offset']
+        self.feed_cursor = FeedCursor(lambda offset: self.save_state(offset=offset))
         while True:
-            for planning_data in self.get_teders_list():
+            for start_date, planning_data, page in self.get_teders_list():
                 if len(planning_data) == 1:
                     logger.info('Tender {0} selected for planning'.format(*planning_data))
-                    self.start_auction_worker_cmd('planning', planning_data[0])
+                    self.schedule_planning(start_date, planning_data[0], feed_entry=page)
                 elif len(planning_data) == 2:
                     logger.info('Lot {1} of tender {0} selected for planning'.format(*planning_data))
-                    self.start_auction_worker_cmd('planning', planning_data[0], lot_id=planning_data[1])
+                    self.schedule_planning(start_date, planning_data[0], lot_id=planning_data[1],
+                                           feed_entry=page)
             logger.info('Sleep...',
                         extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_SLEEP})
             sleep(100)
@@ -295,20 +687,48 @@ class AuctionsDataBridge(object):
 
     def run_re_planning(self):
         self.re_planning = True
-        self.offset = ''
         logger.info('Start Auctions Bridge for re-planning...',
                     extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_START_BRIDGE})
-        for tender_item in self.get_teders_list(re_planning=True):
-            logger.debug('Tender {} selected for re-planning'.format(tender_item))
-            for planning_data in self.get_teders_list():
+        # Re-planning goes through the whole feed and never saves its position
+        self.feed_cursor = FeedCursor(lambda offset: None)
+        auctions = []
+        for start_date, planning_data, page in self.get_teders_list(re_planning=True):
+            self.feed_cursor.release(page)
+            auction_id = "_".join(planning_data)
+            if auction_id not in self.tenders_ids_list:
+                self.tenders_ids_list.add(auction_id)
                 if len(planning_data) == 1:
                     logger.info('Tender {0} selected for planning'.format(*planning_data))
-                    self.start_auction_worker_cmd('planning', planning_data[0])
                 elif len(planning_data) == 2:
                     logger.info('Lot {1} of tender {0} selected for planning'.format(*planning_data))
-                    self.start_auction_worker_cmd('planning', planning_data[0], lot_id=planning_data[1])
-                self.tenders_ids_list.append(tender_item['id'])
-            sleep(1)
+                auctions.append((start_date, len(auctions), planning_data[0], None,
+                                 (planning_data[1:] or [None])[0], None))
+        # Soonest auctions first
+        auctions.sort()
+        logger.info('{} auctions selected for re-planning'.format(len(auctions)),
+                    extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_PROGRESS})
+
+        progress = {'done': 0, 'started_at': time(), 'reported_at': time()}
+
+        def re_plan(batch):
+            self.run_planning(batch)
+            progress['done'] += len(batch)
+            now = time()
+            if now - progress['reported_at'] >= 10 or progress['done'] == len(auctions):
+                progress['reported_at'] = now
+                rate = progress['done'] / max(now - progress['started_at'], 1e-6)
+                logger.info(
+                    "Re-planning progress: {}/{} auctions, {:.2f} auctions/s, ETA {:.0f}s".format(
+                        progress['done'], len(auctions), rate,
+                        (len(auctions) - progress['done']) / rate
+                    ),
+                    extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_PROGRESS}
+                )
+
+        for batch in self.planning_batches(auctions):
+            self.planning_pool.spawn(re_plan, batch)
+        self.planning_pool.join()
+        self.log_timings()
         logger.info("Re-planning auctions finished",
                     extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_FINISHED})
 
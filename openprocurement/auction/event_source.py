@@ -1,14 +1,32 @@
 from sse import Sse as PySse
 from flask import json, current_app, Blueprint, request, session, Response
 from flask import jsonify, abort
-from gevent.queue import Queue
+from gevent.queue import Queue, Empty
 from gevent import spawn, sleep
+from gevent.event import Event
 import logging
+from collections import namedtuple
 from datetime import datetime
-from openprocurement.auction.utils import prepare_extra_journal_fields, get_bidder_id
+from functools import partial
+from hmac import compare_digest
+from math import floor
+from pytz import utc
+from time import time
+from openprocurement.auction.utils import (
+    prepare_extra_journal_fields, get_bidder_id, parse_date, to_timestamp
+)
 
 LOGGER = logging.getLogger(__name__)
 CHUNK = ' ' * 2048 + '\n'
+HUB_HEADER = 'X-Auctions-Hub'
+HUB_SECRET_HEADER = 'X-Auctions-Hub-Secret'
+HUB_HEARTBEAT = 15
+DEFAULT_CHANNEL_SIZE = 16
+DEFAULT_HUB_CHANNEL_SIZE = 1024
+OVERFLOW_COALESCE = 'coalesce'
+OVERFLOW_DISCONNECT = 'disconnect'
+COALESCED_EVENTS = ('Tick', 'ClientsList')
+TICK_INTERVAL = 5
 
 
 def sse_timeout(queue, sleep_seconds):
@@ -17,11 +35,73 @@ def sse_timeout(queue, sleep_seconds):
         queue.put({"event": "StopSSE"})
 
 
+class SseEvent(namedtuple('SseEvent', 'event data frame')):
+    """Event serialised and framed once and shared by all channels"""
+    __slots__ = ()
+
+
+def sse_event(data, event=""):
+    sse = PySse()
+    sse.flush()
+    sse.add_message(event, json.dumps(data))
+    return SseEvent(event, data, ''.join(sse).encode('u8'))
+
+
+def event_name(message):
+    if isinstance(message, SseEvent):
+        return message.event
+    return message["event"]
+
+
+class ClientChannel(Queue):
+    """
+    Bounded channel of a client. When it is full the 'coalesce' policy
+    keeps only the latest queued Tick and ClientsList, the client is
+    disconnected if the channel is still full or with 'disconnect' policy
+    """
+
+    def __init__(self, max_size=DEFAULT_CHANNEL_SIZE, overflow=OVERFLOW_COALESCE,
+                 on_disconnect=None):
+        Queue.__init__(self)
+        self.max_size = max_size
+        self.overflow = overflow
+        self.on_disconnect = on_disconnect
+        self.closed = False
+
+    def put(self, message, block=True, timeout=None):
+        if self.closed:
+            return
+        if len(self.queue) >= self.max_size and self.overflow == OVERFLOW_COALESCE:
+            self.coalesce(message)
+        if len(self.queue) >= self.max_size:
+            return self.disconnect()
+        Queue.put(self, message, block, timeout)
+
+    def coalesce(self, message):
+        latest = {}
+        for queued in list(self.queue) + [message]:
+            if event_name(queued) in COALESCED_EVENTS:
+                latest[event_name(queued)] = queued
+        messages = [queued for queued in self.queue
+                    if latest.get(event_name(queued), queued) is queued]
+        self.queue.clear()
+        self.queue.extend(messages)
+
+    def disconnect(self):
+        self.closed = True
+        self.queue.clear()
+        Queue.put(self, {"event": "StopSSE"})
+        if self.on_disconnect is not None:
+            self.on_disconnect()
+
+
 class SseStream(object):
-    def __init__(self, queue, bidder_id=None, client_id=None, timeout=None):
+    def __init__(self, queue, bidder_id=None, client_id=None, timeout=None,
+                 on_close=None):
         self.queue = queue
         self.client_id = client_id
         self.bidder_id = bidder_id
+        self.on_close = on_close
         if timeout:
             self.sse = PySse(default_retry=0)
             spawn(sse_timeout, queue, timeout)
@@ -37,6 +117,9 @@ class SseStream(object):
 
         while True:
             message = self.queue.get()
+            if isinstance(message, SseEvent):
+                yield message.frame
+                continue
             if message["event"] == "StopSSE":
                 return
             LOGGER.debug(' '.join([
@@ -47,6 +130,54 @@ class SseStream(object):
             for data in self.sse:
                 yield data.encode('u8')
 
+    def close(self):
+        # Called by the WSGI server when the response ends or its write fails,
+        # on_close keeps the channel if the client reconnected meanwhile
+        if self.on_close is not None:
+            self.on_close()
+
+
+class HubChannel(object):
+    """
+    Channel of a client connected through an auctions_server events hub,
+    messages are tagged with the client and forwarded to the hub stream
+    """
+
+    def __init__(self, hub_queues, hub_id, bidder_id, client_id):
+        self.hub_queues = hub_queues
+        self.hub_id = hub_id
+        self.bidder_id = bidder_id
+        self.client_id = client_id
+        # Messages sent while the client registers are returned to the hub
+        self.pending = []
+
+    def put(self, message):
+        if isinstance(message, SseEvent):
+            message = {"event": message.event, "data": message.data}
+        message = dict(message, bidder_id=self.bidder_id, client_id=self.client_id)
+        if self.pending is not None:
+            self.pending.append(message)
+        elif self.hub_id in self.hub_queues:
+            self.hub_queues[self.hub_id].put(message)
+
+    def flush_pending(self):
+        pending, self.pending = self.pending, None
+        return pending
+
+    def qsize(self):
+        return 0
+
+
+def hub_request():
+    """
+    Id of the auctions_server events hub which made the request, None
+    if the request has no valid hub secret
+    """
+    secret = current_app.config.get('EVENT_SOURCE_HUB_SECRET')
+    if secret and HUB_HEADER in request.headers and \
+            compare_digest(str(request.headers.get(HUB_SECRET_HEADER, '')), str(secret)):
+        return request.headers[HUB_HEADER]
+
 
 sse = Blueprint('sse', __name__)
 
@@ -84,14 +215,10 @@ def event_source():
     if 'remote_oauth' in session and 'client_id' in session:
         bidder_data = get_bidder_id(current_app, session)
         if bidder_data:
-            valid_bidder = False
             client_hash = session['client_id']
             bidder = bidder_data['bidder_id']
-            for bidder_info in current_app.config['auction'].bidders_data:
-                if bidder_info['id'] == bidder:
-                    valid_bidder = True
-                    break
-            if valid_bidder:
+            bidder_info = current_app.config['auction'].bidders_index.get(bidder)
+            if bidder_info is not None:
                 if bidder not in current_app.auction_bidders:
                     current_app.auction_bidders[bidder] = {
                         "clients": {},
@@ -108,7 +235,21 @@ def event_source():
                         ),
                         'User-Agent': request.headers.get('User-Agent'),
                     }
-                    current_app.auction_bidders[bidder]["channels"][client_hash] = Queue()
+                    hub_id = hub_request()
+                    if hub_id:
+                        channel = HubChannel(current_app.auction_hub_queues, hub_id,
+                                             bidder, client_hash)
+                    else:
+                        channel = ClientChannel(
+                            current_app.config.get('SSE_CHANNEL_SIZE', DEFAULT_CHANNEL_SIZE),
+                            current_app.config.get('SSE_OVERFLOW_POLICY', OVERFLOW_COALESCE)
+                        )
+                        channel.on_disconnect = partial(
+                            disconnect_client, current_app._get_current_object(),
+                            bidder, client_hash, channel
+                        )
+                    current_app.auction_bidders[bidder]["channels"][client_hash] = channel
+                    TICKS.wakeup()
 
                 current_app.logger.info(
                     'Send identification for bidder: {} with client_hash {}'.format(bidder, client_hash),
@@ -118,7 +259,7 @@ def event_source():
                                        "client_id": client_hash,
                                        "return_url": session.get('return_url', '')}
                 if current_app.config['auction'].features:
-                    identification_data["coeficient"] = str(current_app.config['auction'].bidders_coeficient[bidder])
+                    identification_data["coeficient"] = str(bidder_info['coeficient'])
 
                 send_event_to_client(bidder, client_hash, identification_data,
                                      "Identification")
@@ -137,12 +278,21 @@ def event_source():
                         "ClientsList"
                     )
 
+                channel = current_app.auction_bidders[bidder]["channels"][client_hash]
+                if isinstance(channel, HubChannel):
+                    return jsonify({
+                        "bidder_id": bidder,
+                        "client_id": client_hash,
+                        "timeout": session.get("sse_timeout", 0),
+                        "events": channel.flush_pending()
+                    })
                 return Response(
                     SseStream(
                         current_app.auction_bidders[bidder]["channels"][client_hash],
                         bidder_id=bidder,
                         client_id=client_hash,
-                        timeout=session.get("sse_timeout", 0)
+                        timeout=session.get("sse_timeout", 0),
+                        on_close=channel.on_disconnect
                     ),
                     direct_passthrough=True,
                     mimetype='text/event-stream',
@@ -168,6 +318,62 @@ def event_source():
     )
 
 
+@sse.route("/event_source_hub")
+def event_source_hub():
+    # Only for auctions_server which knows the hub secret
+    hub_id = hub_request()
+    if not hub_id:
+        abort(403)
+    app = current_app._get_current_object()
+    # Messages of all clients of the hub share the channel, coalescing
+    # would drop events of other clients
+    queue = ClientChannel(
+        app.config.get('SSE_HUB_CHANNEL_SIZE', DEFAULT_HUB_CHANNEL_SIZE),
+        OVERFLOW_DISCONNECT
+    )
+    previous = app.auction_hub_queues.get(hub_id)
+    if previous is not None:
+        previous.disconnect()
+    app.auction_hub_queues[hub_id] = queue
+
+    def stream():
+        try:
+            yield '\n'
+            while True:
+                try:
+                    message = queue.get(timeout=HUB_HEARTBEAT)
+                except Empty:
+                    yield '\n'
+                    continue
+                if queue.closed:
+                    return
+                yield json.dumps(message) + '\n'
+        finally:
+            if app.auction_hub_queues.get(hub_id) is queue:
+                del app.auction_hub_queues[hub_id]
+                disconnect_hub_clients(app, hub_id)
+
+    return Response(stream(), direct_passthrough=True,
+                    mimetype='application/x-ndjson')
+
+
+@sse.route("/event_source_hub/remove_client", methods=['POST'])
+def event_source_hub_remove_client():
+    if not hub_request():
+        abort(403)
+    bidder_id = request.json['bidder_id']
+    client_id = request.json['client_id']
+    channels = current_app.auction_bidders.get(bidder_id, {}).get("channels", {})
+    if isinstance(channels.get(client_id), HubChannel):
+        remove_client(bidder_id, client_id)
+        send_event(
+            bidder_id,
+            current_app.auction_bidders[bidder_id]["clients"],
+            "ClientsList"
+        )
+    return jsonify({"bidder_id": bidder_id, "client_id": client_id})
+
+
 def send_event_to_client(bidder, client, data, event=""):
     if bidder in current_app.auction_bidders and client in current_app.auction_bidders[bidder]["channels"]:
         return current_app.auction_bidders[bidder]["channels"][client].put({
@@ -177,8 +383,12 @@ def send_event_to_client(bidder, client, data, event=""):
 
 
 def send_event(bidder, data, event=""):
-    for client in current_app.auction_bidders[bidder]["channels"]:
-        send_event_to_client(bidder, client, data, event)
+    return broadcast_event(bidder, sse_event(data, event))
+
+
+def broadcast_event(bidder, message):
+    for channel in current_app.auction_bidders[bidder]["channels"].values():
+        channel.put(message)
     return True
 
 
@@ -190,30 +400,115 @@ def remove_client(bidder_id, client):
             del current_app.auction_bidders[bidder_id]["clients"][client]
 
 
-def push_timestamps_events(app):
-    with app.app_context():
+class TickBroadcaster(object):
+    """
+    Shared clock of the process: one timer serialises the Tick event once
+    and broadcasts it to the clients of all subscribed auction apps.
+    Ticks are aligned to the interval and to the start of the next stage
+    of every auction, the timer sleeps while no client is connected.
+    """
+
+    def __init__(self, interval=TICK_INTERVAL, clock=time, sleep=sleep):
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self.apps = []
+        self.clients_connected = Event()
+        self.timer = None
+
+    def subscribe(self, app):
+        self.apps.append(app)
+        if self.timer is None:
+            self.timer = spawn(self.run)
+
+    def unsubscribe(self, app):
+        self.apps.remove(app)
+        if not self.apps and self.timer is not None:
+            self.timer.kill(block=False)
+            self.timer = None
+
+    def wakeup(self):
+        self.clients_connected.set()
+
+    def has_clients(self):
+        for app in self.apps:
+            for bidder in app.auction_bidders.values():
+                if bidder["channels"]:
+                    return True
+        return False
+
+    def next_stage_start(self, app, now):
+        auction_document = getattr(app.config['auction'], 'auction_document', None) or {}
+        stages = auction_document.get('stages', [])
+        next_stage = auction_document.get('current_stage', -1) + 1
+        if 0 <= next_stage < len(stages):
+            start = to_timestamp(parse_date(stages[next_stage]['start'])) / 1000000.
+            if start > now:
+                return start
+
+    def next_tick(self, now):
+        next_tick = (floor(now / self.interval) + 1) * self.interval
+        for app in self.apps:
+            next_tick = min(next_tick, self.next_stage_start(app, now) or next_tick)
+        return next_tick
+
+    def broadcast(self):
+        now = datetime.fromtimestamp(self.clock(), utc)
+        ticks = {}
+        for app in list(self.apps):
+            tz = app.config['timezone']
+            if tz not in ticks:
+                ticks[tz] = sse_event({"time": now.astimezone(tz).isoformat()}, "Tick")
+            with app.app_context():
+                for bidder_id in app.auction_bidders.keys():
+                    broadcast_event(bidder_id, ticks[tz])
+
+    def run(self):
         while True:
-            sleep(5)
-            time = datetime.now(app.config['timezone']).isoformat()
-            for bidder_id in app.auction_bidders:
-                send_event(bidder_id, {"time": time}, "Tick")
+            if not self.has_clients():
+                self.clients_connected.clear()
+                self.clients_connected.wait()
+            # A small margin keeps an early wakeup from ticking twice
+            now = self.clock()
+            self.sleep(self.next_tick(now + 0.01) - now)
+            self.broadcast()
+
+
+TICKS = TickBroadcaster()
 
 
-def check_clients(app):
+def push_timestamps_events(app, ticks=TICKS):
+    ticks.subscribe(app)
+    try:
+        Event().wait()
+    finally:
+        ticks.unsubscribe(app)
+
+
+def disconnect_hub_clients(app, hub_id):
+    """Remove clients of an events hub whose stream ended"""
     with app.app_context():
-        while True:
-            sleep(30)
-
-            for bidder_id in app.auction_bidders:
-                removed_clients = []
-                for client in app.auction_bidders[bidder_id]["channels"]:
-                    if app.auction_bidders[bidder_id]["channels"][client].qsize() > 3:
-                        removed_clients.append(client)
-                if removed_clients:
-                    for client in removed_clients:
-                        remove_client(bidder_id, client)
-                    send_event(
-                        bidder_id,
-                        app.auction_bidders[bidder_id]["clients"],
-                        "ClientsList"
-                    )
+        for bidder_id, bidder in app.auction_bidders.items():
+            clients = [client for client, channel in bidder["channels"].items()
+                       if isinstance(channel, HubChannel) and channel.hub_id == hub_id]
+            if not clients:
+                continue
+            app.logger.info("Disconnect clients {} of bidder {} with events hub {}".format(
+                ', '.join(clients), bidder_id, hub_id))
+            for client in clients:
+                remove_client(bidder_id, client)
+            send_event(bidder_id, bidder["clients"], "ClientsList")
+
+
+def disconnect_client(app, bidder_id, client, channel):
+    with app.app_context():
+        channels = app.auction_bidders.get(bidder_id, {}).get("channels", {})
+        if channels.get(client) is not channel:
+            return
+        app.logger.info("Disconnect client {} of bidder {}".format(client, bidder_id))
+        remove_client(bidder_id, client)
+        send_event(
+            bidder_id,
+            app.auction_bidders[bidder_id]["clients"],
+            "ClientsList"
+        )
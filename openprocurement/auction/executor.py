@@ -1,5 +1,10 @@
+import sys
+
+from apscheduler.executors.base import run_job
 from apscheduler.executors.gevent import GeventExecutor
 
+from .host import JOURNAL_CONTEXT
+
 
 class AuctionsExecutor(GeventExecutor):
 
@@ -14,3 +19,17 @@ class AuctionsExecutor(GeventExecutor):
         self._scheduler = scheduler
         self._lock = scheduler._create_lock()
         self._logger = scheduler._logger
+
+    def _do_submit_job(self, job, run_times):
+        def callback(greenlet):
+            try:
+                events = greenlet.get()
+            except BaseException:
+                self._run_job_error(job.id, *sys.exc_info()[1:])
+            else:
+                self._run_job_success(job.id, events)
+
+        # Jobs of a hosted auction log with its journal fields
+        journal_fields = getattr(getattr(job.func, '__self__', None), 'journal_fields', {})
+        JOURNAL_CONTEXT.spawn(journal_fields, run_job, job, job._jobstore_alias,
+                              run_times, self._logger.name).link(callback)
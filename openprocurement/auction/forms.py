@@ -24,7 +24,7 @@ def validate_bid_change_on_bidding(form, field):
     stage_id = form.document['current_stage']
     if form.auction.features:
         minimal_bid = form.document['stages'][stage_id]['amount_features']
-        minimal = Fraction(minimal_bid) * form.auction.bidders_coeficient[form.data['bidder_id']]
+        minimal = Fraction(minimal_bid) * form.auction.bidders_index[form.data['bidder_id']]['coeficient']
         minimal -= Fraction(form.document['minimalStep']['amount'])
         if field.data > minimal:
             raise ValidationError(u'Too high value')
@@ -61,3 +61,74 @@ class BidsForm(Form):
         stage_id = self.document['current_stage']
         if self.document['stages'][stage_id]['type'] == 'bids':
             validate_bidder_id_on_bidding(self, field)
+
+
+class BidsValidator(object):
+    """
+    Compiled BidsForm for well-formed bids: the bid ceilings of the current
+    stage are computed once per stage and a bid is checked with a few
+    comparisons. Any other input is validated by BidsForm itself.
+    The auction prepares each stage when it starts, validate prepares a
+    stage which was not prepared yet.
+    """
+
+    def __init__(self, auction):
+        self.auction = auction
+        self.stage = None
+
+    def reset(self):
+        """Forget prepared ceilings, bidders of the auction changed"""
+        self.stage = None
+
+    def prepare(self, document):
+        self.stage = None
+        stage = document['stages'][document['current_stage']]
+        self.bidding = stage['type'] == 'bids'
+        self.stage_bidder = stage.get('bidder_id')
+        self.ceilings = {}
+        if self.bidding and self.auction.features:
+            for bidder_id, bidder in self.auction.bidders_index.items():
+                minimal = Fraction(stage['amount_features']) * bidder['coeficient']
+                minimal -= Fraction(document['minimalStep']['amount'])
+                # Nearest float and whether it is above the exact ceiling,
+                # float bids compare as they would against the Fraction
+                self.ceilings[bidder_id] = (float(minimal), float(minimal) > minimal)
+        elif self.bidding:
+            self.ceiling = stage['amount'] - document['minimalStep']['amount']
+        self.stage = document['current_stage']
+
+    def validate_with_form(self, data, document):
+        form = BidsForm.from_json(data)
+        form.auction = self.auction
+        form.document = document
+        form.validate()
+        return form.data, form.errors
+
+    def validate(self, data, document):
+        """Returns bid data and errors as BidsForm does"""
+        bidder_id = data.get('bidder_id') if isinstance(data, dict) else None
+        bid = data.get('bid') if isinstance(data, dict) else None
+        if not (isinstance(bidder_id, basestring) and bidder_id and
+                type(bid) in (int, long, float) and bid):
+            return self.validate_with_form(data, document)
+        if document['current_stage'] != self.stage:
+            self.prepare(document)
+        bidder_id = unicode(bidder_id)
+        bid = float(bid)
+        errors = {}
+        if self.bidding and bidder_id != self.stage_bidder:
+            errors['bidder_id'] = [u'Not valid bidder']
+        bid_errors = []
+        if bid <= 0.0 and bid != -1:
+            bid_errors.append(u'To low value')
+        if not self.bidding:
+            bid_errors.append(u'Stage not for bidding')
+        elif self.auction.features:
+            ceiling, above = self.ceilings[bidder_id]
+            if bid > ceiling or (bid == ceiling and above):
+                bid_errors.append(u'Too high value')
+        elif bid > self.ceiling:
+            bid_errors.append(u'Too high value')
+        if bid_errors:
+            errors['bid'] = bid_errors
+        return {'bidder_id': bidder_id, 'bid': bid}, errors
@@ -0,0 +1,210 @@
+import json
+import logging
+import os
+from copy import deepcopy
+
+from couchdb import Database, Session
+from gevent import spawn, joinall, wait
+from gevent.local import local
+from gevent.pywsgi import WSGIServer
+from gevent.server import StreamServer
+from gevent.socket import socket, AF_UNIX, SOCK_STREAM
+from werkzeug.exceptions import NotFound
+from werkzeug.wsgi import peek_path_info, pop_path_info
+
+from .prefork import (
+    send_status, STATUS_ACCEPTED, STATUS_SCHEDULED, STATUS_DONE, STATUS_FAILED
+)
+from .server import (
+    _LoggerStream, AuctionsWSGIHandler, create_app,
+    push_timestamps_events, log_logins_cache_stats
+)
+from .utils import get_lisener, create_mapping, delete_mapping
+
+logger = logging.getLogger('Auction Worker')
+
+
+class JournalContext(logging.Filter):
+    """
+    Adds journal fields (TENDER_ID, ...) of the auction served by the
+    current greenlet to log records, the host process logs for many
+    auctions and its journal handler has no fields of its own
+    """
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.local = local()
+
+    def bind(self, fields):
+        self.local.fields = fields
+
+    def spawn(self, fields, func, *args, **kwargs):
+        def run():
+            self.bind(fields)
+            return func(*args, **kwargs)
+        return spawn(run)
+
+    def filter(self, record):
+        for key, value in getattr(self.local, 'fields', {}).iteritems():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+JOURNAL_CONTEXT = JournalContext()
+
+
+class AuctionsDispatcher(object):
+    """WSGI application routing /<auction_doc_id>/... to the auction app"""
+
+    def __init__(self):
+        self.apps = {}
+
+    def __call__(self, environ, start_response):
+        app, journal_fields = self.apps.get(peek_path_info(environ), (None, None))
+        if app is None:
+            return NotFound()(environ, start_response)
+        JOURNAL_CONTEXT.bind(journal_fields)
+        pop_path_info(environ)
+        return app(environ, start_response)
+
+
+class HostedServer(object):
+    """Server handle of one auction in the shared host server"""
+
+    def __init__(self, dispatcher, auction_doc_id, greenlets):
+        self.dispatcher = dispatcher
+        self.auction_doc_id = auction_doc_id
+        self.greenlets = greenlets
+
+    def stop(self):
+        self.dispatcher.apps.pop(self.auction_doc_id, None)
+        for greenlet in self.greenlets:
+            greenlet.kill(block=False)
+
+
+class AuctionsHost(object):
+    """
+    Runs many auctions in one process with a shared CouchDB session and
+    a shared WSGI server routing requests by auction_doc_id. Auctions are
+    given on start or handed off through ``socket_path`` by
+    auction_worker_handoff, which systemd units run when WORKER_HOST_SOCKET
+    is configured
+    """
+
+    def __init__(self, worker_defaults, socket_path=None):
+        super(AuctionsHost, self).__init__()
+        self.worker_defaults = worker_defaults
+        self.socket_path = socket_path and os.path.expanduser(socket_path)
+        self.db = Database(str(worker_defaults["COUCH_DATABASE"]),
+                           session=Session(retry_delays=range(10)))
+        self.dispatcher = AuctionsDispatcher()
+        self.lisener = get_lisener(worker_defaults["STARTS_PORT"],
+                                   host=worker_defaults.get("WORKER_BIND_IP", ""))
+        self.server = WSGIServer(self.lisener, self.dispatcher,
+                                 log=_LoggerStream(logger),
+                                 handler_class=AuctionsWSGIHandler)
+        self.handoff_server = None
+        logger.addFilter(JOURNAL_CONTEXT)
+
+    def spawn(self, auction, func, *args, **kwargs):
+        return JOURNAL_CONTEXT.spawn(auction.journal_fields, func, *args, **kwargs)
+
+    def run_server(self, auction, mapping_expire_time, logger, timezone='Europe/Kiev'):
+        app = create_app(auction, logger, timezone)
+        self.dispatcher.apps[auction.auction_doc_id] = (app, auction.journal_fields)
+        mapping_value = "http://{0}:{1}/{2}/".format(
+            self.lisener.getsockname()[0], self.lisener.getsockname()[1],
+            auction.auction_doc_id
+        )
+        create_mapping(auction.worker_defaults["REDIS_URL"],
+                       auction.auction_doc_id,
+                       mapping_value)
+        app.logger.info("Server mapping: {} -> {}".format(
+            auction.auction_doc_id,
+            mapping_value,
+        ), extra={"JOURNAL_REQUEST_ID": auction.request_id})
+        return HostedServer(self.dispatcher, auction.auction_doc_id, [
+            self.spawn(auction, push_timestamps_events, app,),
+            self.spawn(auction, log_logins_cache_stats, app)
+        ])
+
+    def run_auction(self, auction, connection=None):
+        JOURNAL_CONTEXT.bind(auction.journal_fields)
+        try:
+            auction.schedule_auction()
+        except (Exception, SystemExit), e:
+            logger.error("Auction {} not scheduled: {!r}".format(auction.auction_doc_id, e),
+                         extra={"JOURNAL_REQUEST_ID": auction.request_id})
+            self.stop_auction(auction)
+            if connection is not None:
+                send_status(connection, STATUS_FAILED, error=repr(e))
+            return
+        if connection is not None:
+            send_status(connection, STATUS_SCHEDULED)
+        auction.wait_to_end()
+        if connection is not None:
+            send_status(connection, STATUS_DONE)
+
+    def stop_auction(self, auction):
+        from .auction_worker import SCHEDULER
+
+        logger.warning("Stop auction {}".format(auction.auction_doc_id),
+                       extra={"JOURNAL_REQUEST_ID": auction.request_id})
+        for job in SCHEDULER.get_jobs():
+            if job.id.startswith(auction.get_job_id('')):
+                job.remove()
+        auction.persister.stop()
+        if getattr(auction, 'server', None) is not None:
+            auction.server.stop()
+            delete_mapping(auction.worker_defaults["REDIS_URL"],
+                           auction.auction_doc_id)
+
+    def handle_handoff(self, connection, address):
+        from .auction_worker import Auction
+
+        request = json.loads(connection.makefile().readline())
+        send_status(connection, STATUS_ACCEPTED, pid=os.getpid())
+        worker_defaults = deepcopy(self.worker_defaults)
+        if request.get('with_api_version'):
+            worker_defaults['TENDERS_API_VERSION'] = request['with_api_version']
+        auction_data = None
+        if request.get('auction_info'):
+            with open(request['auction_info']) as auction_info:
+                auction_data = json.load(auction_info)
+        auction = Auction(request['tender_id'],
+                          worker_defaults=worker_defaults,
+                          auction_data=auction_data,
+                          lot_id=request.get('lot_id'),
+                          host=self)
+        JOURNAL_CONTEXT.bind(auction.journal_fields)
+        runner = self.spawn(auction, self.run_auction, auction, connection)
+        watcher = spawn(connection.recv, 1)
+        wait([runner, watcher], count=1)
+        if runner.ready():
+            watcher.kill()
+        else:
+            # The hand-off client went away: its systemd unit is stopped
+            runner.kill()
+            self.stop_auction(auction)
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        listener = socket(AF_UNIX, SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(128)
+        self.handoff_server = StreamServer(listener, self.handle_handoff)
+        self.handoff_server.start()
+        logger.info("Accept auctions hand-off on {}".format(self.socket_path))
+
+    def run(self, auctions):
+        self.server.start()
+        logger.info("Start host server on {0}:{1}".format(*self.lisener.getsockname()))
+        if self.socket_path:
+            self.serve()
+        joinall([self.spawn(auction, self.run_auction, auction)
+                 for auction in auctions])
+        if self.handoff_server is not None:
+            self.handoff_server.serve_forever()
+        self.server.stop()
@@ -0,0 +1,53 @@
+import logging
+
+from gevent import spawn, sleep
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore
+
+logger = logging.getLogger('Auction Worker')
+
+
+class WriteBehindPersister(object):
+    """
+    Coalesce auction document saves into one write per flush interval.
+
+    Only the latest state matters: ``save`` always serializes the current
+    in-memory document, so any number of ``schedule`` calls between two
+    flushes end up in a single CouchDB write.
+    """
+
+    def __init__(self, save, flush_interval=1, sleep=sleep, spawn=spawn):
+        super(WriteBehindPersister, self).__init__()
+        self.save = save
+        self.flush_interval = flush_interval
+        self.sleep = sleep
+        self.spawn = spawn
+        self._dirty = Event()
+        self._lock = BoundedSemaphore()
+        self._worker = None
+
+    def schedule(self):
+        self._dirty.set()
+        if self._worker is None or self._worker.dead:
+            self._worker = self.spawn(self._run)
+
+    def flush(self):
+        with self._lock:
+            self._dirty.clear()
+            return self.save()
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.kill()
+            self._worker = None
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            self.sleep(self.flush_interval)
+            if not self._dirty.is_set():
+                continue
+            try:
+                self.flush()
+            except Exception, e:
+                logger.error("Error while flush document: {}".format(e))
@@ -0,0 +1,245 @@
+"""
+Pre-forked pool of warm auction worker processes.
+
+The pool master keeps ``size`` idle forked children waiting on a UNIX
+socket, every child imports and monkey-patches the auction worker right
+after the fork. The light ``auction_worker_handoff`` client passes an
+auction to one of them, so an auction starts without paying the
+interpreter start-up cost.
+
+The client stays connected until the auction ends and exits with its
+result, so the systemd unit running it lives exactly as long as the
+auction and stopping the unit (closing the connection) stops the
+auction.
+
+This module keeps its top-level imports in the standard library: the
+hand-off client and the pool master must stay cheap and unpatched.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+from select import select
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_SOCKET = '~/.auction_worker_pool.sock'
+
+STATUS_ACCEPTED = 'accepted'
+STATUS_SCHEDULED = 'scheduled'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUSES = (STATUS_ACCEPTED, STATUS_SCHEDULED, STATUS_DONE)
+
+
+def send_status(connection, status, **message):
+    message['status'] = status
+    connection.sendall(json.dumps(message) + '\n')
+
+
+def handoff(socket_path, tender_id, lot_id=None, with_api_version=None,
+            auction_info=None, wait=STATUS_DONE, timeout=10):
+    """
+    Pass an auction to the pool, returns the first status message not
+    before ``wait`` or the failure. The connection is closed on return,
+    which stops the auction if it is still running
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    client.connect(os.path.expanduser(socket_path))
+    try:
+        client.sendall(json.dumps({
+            'tender_id': tender_id,
+            'lot_id': lot_id,
+            'with_api_version': with_api_version,
+            'auction_info': auction_info
+        }) + '\n')
+        messages = client.makefile()
+        while True:
+            line = messages.readline()
+            if not line:
+                return {'status': STATUS_FAILED, 'error': 'connection closed'}
+            message = json.loads(line)
+            if message['status'] == STATUS_ACCEPTED:
+                # Scheduling and the auction itself take their time
+                client.settimeout(None)
+            if message['status'] not in STATUSES or \
+                    STATUSES.index(message['status']) >= STATUSES.index(wait):
+                return message
+    finally:
+        client.close()
+
+
+class WorkersPool(object):
+    """
+    Keeps ``size`` forked children idle and ready to run
+    ``target(request, connection)``, each child calls ``prepare()`` first
+    """
+
+    def __init__(self, socket_path, target, size=DEFAULT_POOL_SIZE, prepare=None):
+        super(WorkersPool, self).__init__()
+        self.socket_path = os.path.expanduser(socket_path)
+        self.target = target
+        self.prepare = prepare
+        self.size = size
+        self.idle = set()
+        self.busy = set()
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(128)
+        self.status_r, self.status_w = os.pipe()
+
+    def spawn_child(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(self.status_r)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.child()
+            finally:
+                os._exit(0)
+        self.idle.add(pid)
+
+    def child(self):
+        if self.prepare is not None:
+            self.prepare()
+        connection, _ = self.listener.accept()
+        self.listener.close()
+        os.write(self.status_w, '{}\n'.format(os.getpid()))
+        os.close(self.status_w)
+        request = json.loads(connection.makefile().readline())
+        send_status(connection, STATUS_ACCEPTED, pid=os.getpid())
+        self.target(request, connection)
+
+    def reap_children(self):
+        while self.idle or self.busy:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            self.idle.discard(pid)
+            self.busy.discard(pid)
+
+    def run(self):
+        self.listen()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                while len(self.idle) < self.size:
+                    self.spawn_child()
+                if select([self.status_r], [], [], 1)[0]:
+                    for pid in os.read(self.status_r, 4096).split():
+                        self.idle.discard(int(pid))
+                        self.busy.add(int(pid))
+                self.reap_children()
+        finally:
+            for pid in self.idle:
+                os.kill(pid, signal.SIGTERM)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+def prepare_worker():
+    # Runs in the forked child only, the master never gets monkey-patched
+    from . import auction_worker
+
+
+def configure_logging(worker_defaults, request):
+    from logging.config import dictConfig
+
+    journal = worker_defaults['handlers']['journal']
+    journal['TENDER_ID'] = request['tender_id']
+    if request.get('lot_id'):
+        journal['TENDER_LOT_ID'] = request['lot_id']
+    for key in ('TENDERS_API_VERSION', 'TENDERS_API_URL',):
+        journal[key] = worker_defaults[key]
+    dictConfig(worker_defaults)
+
+
+def stop_on_close(connection):
+    # The hand-off client went away: its systemd unit is stopped
+    if not connection.recv(1):
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def run_auction(worker_defaults, request, connection):
+    from copy import deepcopy
+    from gevent import spawn
+    from gevent.socket import socket as cooperative_socket
+    from .auction_worker import Auction, SCHEDULER
+
+    connection = cooperative_socket(_sock=connection._sock)
+    worker_defaults = deepcopy(worker_defaults)
+    if request.get('with_api_version'):
+        worker_defaults['TENDERS_API_VERSION'] = request['with_api_version']
+    configure_logging(worker_defaults, request)
+    auction_data = None
+    if request.get('auction_info'):
+        with open(request['auction_info']) as auction_info:
+            auction_data = json.load(auction_info)
+
+    auction = Auction(request['tender_id'],
+                      worker_defaults=worker_defaults,
+                      auction_data=auction_data,
+                      lot_id=request.get('lot_id'))
+    SCHEDULER.start()
+    try:
+        auction.schedule_auction()
+    except (Exception, SystemExit), e:
+        send_status(connection, STATUS_FAILED, error=repr(e))
+        return
+    send_status(connection, STATUS_SCHEDULED)
+    watcher = spawn(stop_on_close, connection)
+    auction.wait_to_end()
+    SCHEDULER.shutdown()
+    watcher.kill()
+    send_status(connection, STATUS_DONE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Auction Workers Pool ----')
+    parser.add_argument('auction_worker_config', type=str,
+                        help='Auction Worker Configuration File')
+    parser.add_argument('--size', type=int, default=None,
+                        help='Number of idle workers')
+    args = parser.parse_args()
+    if not os.path.isfile(args.auction_worker_config):
+        print "Auction worker defaults config not exists!!!"
+        sys.exit(1)
+    with open(args.auction_worker_config) as config_file:
+        worker_defaults = json.load(config_file)
+    pool = WorkersPool(
+        worker_defaults.get('WORKER_POOL_SOCKET', DEFAULT_SOCKET),
+        lambda request, connection: run_auction(worker_defaults, request, connection),
+        size=args.size or worker_defaults.get('WORKER_POOL_SIZE', DEFAULT_POOL_SIZE),
+        prepare=prepare_worker
+    )
+    pool.run()
+
+
+def handoff_main():
+    parser = argparse.ArgumentParser(description='---- Auction Worker Hand-off ----')
+    parser.add_argument('tender_id', type=str, help='Tender id')
+    parser.add_argument('socket', type=str, help='Workers pool socket')
+    parser.add_argument('--lot', type=str, help='Specify lot in tender', default=None)
+    parser.add_argument('--with_api_version', type=str, help='Tender Api Version')
+    parser.add_argument('--auction_info', type=str, help='Auction File')
+    parser.add_argument('--wait', type=str, default=STATUS_DONE, choices=STATUSES,
+                        help='Return once the auction reached this status')
+    args = parser.parse_args()
+    try:
+        response = handoff(args.socket, args.tender_id, lot_id=args.lot,
+                           with_api_version=args.with_api_version,
+                           auction_info=args.auction_info and os.path.abspath(args.auction_info),
+                           wait=args.wait)
+    except (socket.error, ValueError), e:
+        print "Hand-off failed: {}".format(e)
+        sys.exit(1)
+    if response['status'] == STATUS_FAILED:
+        print "Auction {} failed: {}".format(args.tender_id, response.get('error'))
+        sys.exit(1)
+    print "Auction {} {}".format(args.tender_id, response['status'])
@@ -1,8 +1,10 @@
 from flask_oauthlib.client import OAuth
-from flask import Flask, request, jsonify, url_for, session, abort, redirect
+from flask import (
+    Flask, Blueprint, current_app, request, jsonify, url_for, session, abort,
+    redirect
+)
 import os
 from urlparse import urljoin
-import iso8601
 from dateutil.tz import tzlocal
 
 from gevent.pywsgi import WSGIServer, WSGIHandler
@@ -10,22 +12,20 @@ from gevent import socket
 import errno
 from datetime import datetime, timedelta
 from pytz import timezone
-from openprocurement.auction.forms import BidsForm
-from openprocurement.auction.utils import get_lisener, create_mapping, prepare_extra_journal_fields, get_bidder_id
+from openprocurement.auction.utils import (
+    get_lisener, create_mapping, prepare_extra_journal_fields, get_bidder_id,
+    LoginsCache, LOGINS_STATS_INTERVAL
+)
 from openprocurement.auction.event_source import (
     sse, send_event, send_event_to_client, remove_client,
-    push_timestamps_events, check_clients
+    push_timestamps_events
 )
 
 from pytz import timezone as tz
-from gevent import spawn
+from gevent import spawn, sleep
 
 
-app = Flask(__name__, static_url_path='', template_folder='static')
-app.auction_bidders = {}
-app.register_blueprint(sse)
-app.secret_key = os.urandom(24)
-app.logins_cache = {}
+auction_views = Blueprint('auction', __name__)
 
 INVALIDATE_GRANT = timedelta(0, 230)
 
@@ -68,71 +68,70 @@ class AuctionsWSGIHandler(WSGIHandler):
             log.write(self.format_request(), extra=extra)
 
 
-@app.route('/login')
+@auction_views.route('/login')
 def login():
     if 'bidder_id' in request.args and 'hash' in request.args:
-        for bidder_info in app.config['auction'].bidders_data:
-            if bidder_info['id'] == request.args['bidder_id']:
-                next_url = request.args.get('next') or request.referrer or None
-                if 'X-Forwarded-Path' in request.headers:
-                    callback_url = urljoin(
-                        request.headers['X-Forwarded-Path'],
-                        'authorized'
-                    )
-                else:
-                    callback_url = url_for('authorized', next=next_url, _external=True)
-                response = app.remote_oauth.authorize(
-                    callback=callback_url,
-                    bidder_id=request.args['bidder_id'],
-                    hash=request.args['hash']
+        if request.args['bidder_id'] in current_app.config['auction'].bidders_index:
+            next_url = request.args.get('next') or request.referrer or None
+            if 'X-Forwarded-Path' in request.headers:
+                callback_url = urljoin(
+                    request.headers['X-Forwarded-Path'],
+                    'authorized'
                 )
-                if 'return_url' in request.args:
-                    session['return_url'] = request.args['return_url']
-                session['login_bidder_id'] = request.args['bidder_id']
-                session['login_hash'] = request.args['hash']
-                session['login_callback'] = callback_url
-                app.logger.debug("Session: {}".format(repr(session)))
-                return response
+            else:
+                callback_url = url_for('.authorized', next=next_url, _external=True)
+            response = current_app.remote_oauth.authorize(
+                callback=callback_url,
+                bidder_id=request.args['bidder_id'],
+                hash=request.args['hash']
+            )
+            if 'return_url' in request.args:
+                session['return_url'] = request.args['return_url']
+            session['login_bidder_id'] = request.args['bidder_id']
+            session['login_hash'] = request.args['hash']
+            session['login_callback'] = callback_url
+            current_app.logger.debug("Session: {}".format(repr(session)))
+            return response
     return abort(401)
 
 
-@app.route('/authorized')
+@auction_views.route('/authorized')
 def authorized():
     if not('error' in request.args and request.args['error'] == 'access_denied'):
-        resp = app.remote_oauth.authorized_response()
+        resp = current_app.remote_oauth.authorized_response()
         if resp is None or hasattr(resp, 'data'):
-            app.logger.info("Error Response from Oauth: {}".format(resp))
+            current_app.logger.info("Error Response from Oauth: {}".format(resp))
             return abort(403, 'Access denied')
-        app.logger.info("Get response from Oauth: {}".format(repr(resp)))
+        current_app.logger.info("Get response from Oauth: {}".format(repr(resp)))
         session['remote_oauth'] = (resp['access_token'], '')
         session['client_id'] = os.urandom(16).encode('hex')
-    bidder_data = get_bidder_id(app, session)
-    app.logger.info("Bidder {} with client_id {} authorized".format(
+    bidder_data = get_bidder_id(current_app, session)
+    current_app.logger.info("Bidder {} with client_id {} authorized".format(
                     bidder_data['bidder_id'], session['client_id'],
                     ), extra=prepare_extra_journal_fields(request.headers))
 
-    app.logger.debug("Session: {}".format(repr(session)))
+    current_app.logger.debug("Session: {}".format(repr(session)))
     response = redirect(
         urljoin(request.headers['X-Forwarded-Path'], '.').rstrip('/')
     )
     response.set_cookie('auctions_loggedin', '1',
-                        path=app.config['SESSION_COOKIE_PATH'],
+                        path=current_app.config['SESSION_COOKIE_PATH'],
                         secure=False, httponly=False, max_age=36000
                         )
     return response
 
 
-@app.route('/relogin')
+@auction_views.route('/relogin')
 def relogin():
     if (all([key in session
              for key in ['login_callback', 'login_bidder_id', 'login_hash']])):
         if 'amount' in request.args:
             session['amount'] = request.args['amount']
-        app.logger.debug("Session: {}".format(repr(session)))
-        app.logger.info("Bidder {} with login_hash {} start re-login".format(
+        current_app.logger.debug("Session: {}".format(repr(session)))
+        current_app.logger.info("Bidder {} with login_hash {} start re-login".format(
                         session['login_bidder_id'], session['login_hash'],
                         ), extra=prepare_extra_journal_fields(request.headers))
-        return app.remote_oauth.authorize(
+        return current_app.remote_oauth.authorize(
             callback=session['login_callback'],
             bidder_id=session['login_bidder_id'],
             hash=session['login_hash'],
@@ -143,38 +142,39 @@ def relogin():
     )
 
 
-@app.route('/check_authorization', methods=['POST'])
+@auction_views.route('/check_authorization', methods=['POST'])
 def check_authorization():
     if 'remote_oauth' in session and 'client_id' in session:
         # resp = app.remote_oauth.get('me')
-        bidder_data = get_bidder_id(app, session)
+        bidder_data = get_bidder_id(current_app, session)
         if bidder_data:
-            grant_timeout = iso8601.parse_date(bidder_data[u'expires']) - datetime.now(tzlocal())
-            if grant_timeout > INVALIDATE_GRANT:
-                app.logger.info("Bidder {} with client_id {} pass check_authorization".format(
+            grant_expires = current_app.logins_cache.grant_expires(session['remote_oauth'])
+            # Grant without expiry is not trusted, the client re-logins
+            if grant_expires is not None and grant_expires - datetime.now(tzlocal()) > INVALIDATE_GRANT:
+                current_app.logger.info("Bidder {} with client_id {} pass check_authorization".format(
                                 bidder_data['bidder_id'], session['client_id'],
                                 ), extra=prepare_extra_journal_fields(request.headers))
                 return jsonify({'status': 'ok'})
             else:
-                app.logger.info(
+                current_app.logger.info(
                     "Grant will end in a short time. Activate re-login functionality",
                     extra=prepare_extra_journal_fields(request.headers)
                 )
         else:
-            app.logger.warning("Client_id {} didn't passed check_authorization".format(session['client_id']),
+            current_app.logger.warning("Client_id {} didn't passed check_authorization".format(session['client_id']),
                                extra=prepare_extra_journal_fields(request.headers))
     abort(401)
 
 
-@app.route('/logout')
+@auction_views.route('/logout')
 def logout():
     if 'remote_oauth' in session and 'client_id' in session:
-        bidder_data = get_bidder_id(app, session)
+        bidder_data = get_bidder_id(current_app, session)
         if bidder_data:
             remove_client(bidder_data['bidder_id'], session['client_id'])
             send_event(
                 bidder_data['bidder_id'],
-                app.auction_bidders[bidder_data['bidder_id']]["clients"],
+                current_app.auction_bidders[bidder_data['bidder_id']]["clients"],
                 "ClientsList"
             )
     session.clear()
@@ -183,69 +183,75 @@ def logout():
     )
 
 
-@app.route('/postbid', methods=['POST'])
+@auction_views.route('/postbid', methods=['POST'])
 def post_bid():
-    auction = app.config['auction']
+    auction = current_app.config['auction']
     if 'remote_oauth' in session and 'client_id' in session:
-        bidder_data = get_bidder_id(app, session)
-        if bidder_data and bidder_data['bidder_id'] == request.json['bidder_id']:
-            with auction.bids_actions:
-                form = BidsForm.from_json(request.json)
-                form.auction = auction
-                form.document = auction.db.get(auction.auction_doc_id)
-                current_time = datetime.now(timezone('Europe/Kiev'))
-                if form.validate():
-                    # write data
-                    auction.add_bid(form.document['current_stage'],
-                                    {'amount': form.data['bid'],
-                                     'bidder_id': form.data['bidder_id'],
-                                     'time': current_time.isoformat()})
-                    if form.data['bid'] == -1.0:
-                        app.logger.info("Bidder {} with client_id {} canceled bids in stage {} in {}".format(
-                            form.data['bidder_id'], session['client_id'],
-                            form.document['current_stage'], current_time.isoformat()
-                        ), extra=prepare_extra_journal_fields(request.headers))
-                    else:
-                        app.logger.info("Bidder {} with client_id {} placed bid {} in {}".format(
-                            form.data['bidder_id'], session['client_id'],
-                            form.data['bid'], current_time.isoformat()
-                        ), extra=prepare_extra_journal_fields(request.headers))
-                    response = {'status': 'ok', 'data': form.data}
+        bidder_data = get_bidder_id(current_app, session)
+        if bidder_data and bidder_data['bidder_id'] == request.json['bidder_id'] \
+                and bidder_data['bidder_id'] in auction.bidders_index:
+            document = auction.auction_document
+            data, errors = auction.bids_validator.validate(request.json, document)
+            current_time = datetime.now(timezone('Europe/Kiev'))
+            # Bids are appended to the stage log without the auction lock,
+            # the log rejects them once the stage is closed
+            if not errors and not auction.add_bid(document['current_stage'],
+                                                  {'amount': data['bid'],
+                                                   'bidder_id': data['bidder_id'],
+                                                   'time': current_time.isoformat()}):
+                errors = {'bid': [u'Stage not for bidding']}
+            if not errors:
+                if data['bid'] == -1.0:
+                    current_app.logger.info("Bidder {} with client_id {} canceled bids in stage {} in {}".format(
+                        data['bidder_id'], session['client_id'],
+                        document['current_stage'], current_time.isoformat()
+                    ), extra=prepare_extra_journal_fields(request.headers))
                 else:
-                    response = {'status': 'failed', 'errors': form.errors}
-                    app.logger.info("Bidder {} with client_id {} wants place bid {} in {} with errors {}".format(
-                        request.json.get('bidder_id', 'None'), session['client_id'],
-                        request.json.get('bid', 'None'), current_time.isoformat(),
-                        repr(form.errors)
+                    current_app.logger.info("Bidder {} with client_id {} placed bid {} in {}".format(
+                        data['bidder_id'], session['client_id'],
+                        data['bid'], current_time.isoformat()
                     ), extra=prepare_extra_journal_fields(request.headers))
-                return jsonify(response)
+                response = {'status': 'ok', 'data': data}
+            else:
+                response = {'status': 'failed', 'errors': errors}
+                current_app.logger.info("Bidder {} with client_id {} wants place bid {} in {} with errors {}".format(
+                    request.json.get('bidder_id', 'None'), session['client_id'],
+                    request.json.get('bid', 'None'), current_time.isoformat(),
+                    repr(errors)
+                ), extra=prepare_extra_journal_fields(request.headers))
+            return jsonify(response)
         else:
-            app.logger.warning("Client with client id: {} and bidder_id {} wants post bid but response status from Oauth".format(
+            current_app.logger.warning("Client with client id: {} and bidder_id {} wants post bid but response status from Oauth".format(
                 session.get('client_id', 'None'), request.json.get('bidder_id', 'None')
             ))
     abort(401)
 
 
-@app.route('/kickclient', methods=['POST'])
+@auction_views.route('/kickclient', methods=['POST'])
 def kickclient():
     if 'remote_oauth' in session and 'client_id' in session:
-        auction = app.config['auction']
-        with auction.bids_actions:
-            data = request.json
-            bidder_data = get_bidder_id(app, session)
-            if bidder_data:
-                data['bidder_id'] = bidder_data['bidder_id']
-                if 'client_id' in data:
-                    send_event_to_client(
-                        data['bidder_id'], data['client_id'], {
-                            "from": session['client_id']
-                        }, "KickClient"
-                    )
-                    return jsonify({"status": "ok"})
+        data = request.json
+        bidder_data = get_bidder_id(current_app, session)
+        if bidder_data:
+            data['bidder_id'] = bidder_data['bidder_id']
+            if 'client_id' in data:
+                send_event_to_client(
+                    data['bidder_id'], data['client_id'], {
+                        "from": session['client_id']
+                    }, "KickClient"
+                )
+                return jsonify({"status": "ok"})
     abort(401)
 
 
-def run_server(auction, mapping_expire_time, logger, timezone='Europe/Kiev'):
+def create_app(auction, logger, timezone='Europe/Kiev'):
+    app = Flask(__name__, static_url_path='', template_folder='static')
+    app.auction_bidders = {}
+    app.auction_hub_queues = {}
+    app.register_blueprint(sse)
+    app.register_blueprint(auction_views)
+    app.secret_key = os.urandom(24)
+    app.logins_cache = LoginsCache()
     app.config.update(auction.worker_defaults)
     # Replace Flask custom logger
     app.logger_name = logger.name
@@ -269,6 +275,23 @@ def run_server(auction, mapping_expire_time, logger, timezone='Europe/Kiev'):
     def get_oauth_token():
         return session.get('remote_oauth')
     os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = 'true'
+    return app
+
+
+def log_logins_cache_stats(app, interval=LOGINS_STATS_INTERVAL):
+    """Periodically log the logins cache stats when they change"""
+    logged = None
+    while True:
+        sleep(interval)
+        stats = app.logins_cache.stats()
+        if stats != logged:
+            app.logger.info("Logins cache stats: {hits} hits, {misses} misses, "
+                            "{size} tokens".format(**stats))
+            logged = stats
+
+
+def run_server(auction, mapping_expire_time, logger, timezone='Europe/Kiev'):
+    app = create_app(auction, logger, timezone)
 
     # Start server on unused port
     lisener = get_lisener(auction.worker_defaults["STARTS_PORT"],
@@ -294,5 +317,5 @@ def run_server(auction, mapping_expire_time, logger, timezone='Europe/Kiev'):
 
     # Spawn events functionality
     spawn(push_timestamps_events, app,)
-    spawn(check_clients, app, )
+    spawn(log_logins_cache_stats, app)
     return server
@@ -21,6 +21,7 @@ DATA_BRIDGE_RE_PLANNING_START_BRIDGE = uuid.UUID('81a3ed8740c64f50b5ad2182ce015e
 DATA_BRIDGE_RE_PLANNING_TENDER_ALREADY_PLANNED = uuid.UUID('4643bf90d0904b2ba0dadb7df39db4df')
 DATA_BRIDGE_RE_PLANNING_LOT_ALREADY_PLANNED = uuid.UUID('a90119994c24400a99e53380b8b0ef72')
 DATA_BRIDGE_RE_PLANNING_FINISHED = uuid.UUID('0f95ea5b48bb4858acf070ac23f35930')
+DATA_BRIDGE_RE_PLANNING_PROGRESS = uuid.UUID('ef7b493492894919b987ba80f3d4ab4a')
 
 
 #log ID for auction_worker
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for auction worker hot paths.
+
+Usage: python -m openprocurement.auction.tests.benchmarks [name ...]
+"""
+import argparse
+from copy import deepcopy
+from timeit import timeit
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def prepare_auction_document(bidders_count, rounds=3):
+    stage = {
+        "type": "bids", "bidder_id": "", "amount": 0, "time": "",
+        "start": "2015-04-24T11:07:30.723296+03:00",
+        "amount_features": "0", "coeficient": "1",
+        "label": {"en": "", "ru": "", "uk": ""}
+    }
+    document = {
+        "current_stage": 1, "initial_bids": [], "results": [], "stages": []
+    }
+    for bidder in xrange(bidders_count):
+        bid = dict(stage, bidder_id=str(bidder), amount=1000 - bidder)
+        document["initial_bids"].append(bid)
+        document["results"].append(dict(bid))
+    for index in xrange((bidders_count + 1) * rounds + 2):
+        document["stages"].append(deepcopy(stage))
+    return document
+
+
+@benchmark
+def public_document(number=200):
+    from openprocurement.auction.utils import PublicDocumentBuilder, filter_amount
+
+    def full_copy(document):
+        public = deepcopy(document)
+        for section in ['initial_bids', 'stages', 'results']:
+            public[section] = map(filter_amount, public[section])
+        return public
+
+    for bidders_count in (2, 5, 10, 25, 50):
+        document = prepare_auction_document(bidders_count)
+        builder = PublicDocumentBuilder()
+
+        def change_and_build(build):
+            document["current_stage"] += 1
+            stage = document["stages"][
+                document["current_stage"] % len(document["stages"])
+            ]
+            stage["time"] = str(document["current_stage"])
+            return build(document)
+
+        deep = timeit(lambda: change_and_build(full_copy), number=number)
+        incremental = timeit(
+            lambda: change_and_build(
+                lambda d: builder.build(d, hide_amounts=True)
+            ),
+            number=number
+        )
+        print "bidders: {:>3} deepcopy: {:.4f}s builder: {:.4f}s".format(
+            bidders_count, deep, incremental
+        )
+
+
+@benchmark
+def sorting(number=200):
+    import random
+    from fractions import Fraction
+    from openprocurement.auction.utils import get_time, sorting_by_amount
+
+    def bids_compare(bid1, bid2):
+        if "amount_features" in bid1 and "amount_features" in bid2:
+            full_amount_bid1 = Fraction(bid1["amount_features"])
+            full_amount_bid2 = Fraction(bid2["amount_features"])
+        else:
+            full_amount_bid1 = bid1["amount"]
+            full_amount_bid2 = bid2["amount"]
+        if full_amount_bid1 == full_amount_bid2:
+            return - cmp(get_time(bid2), get_time(bid1))
+        return cmp(full_amount_bid1, full_amount_bid2)
+
+    random.seed(0)
+    for bidders_count in (2, 10, 50):
+        for with_features in (False, True):
+            bids = []
+            for bidder in xrange(bidders_count):
+                bid = {
+                    'bidder_id': str(bidder),
+                    'amount': float(random.randint(1, 5) * 1000),
+                    'time': '2015-04-24T11:07:{:02d}+03:00'.format(
+                        random.randint(0, 59))
+                }
+                if with_features:
+                    bid['amount_features'] = str(
+                        Fraction(int(bid['amount']), random.randint(1, 3)))
+                bids.append(bid)
+            assert sorting_by_amount(bids) == sorted(bids, reverse=True, cmp=bids_compare)
+            old = timeit(lambda: sorted(bids, reverse=True, cmp=bids_compare), number=number)
+            new = timeit(lambda: sorting_by_amount(bids), number=number)
+            print "bidders: {:>3} features: {:d} cmp: {:.4f}s key: {:.4f}s".format(
+                bidders_count, with_features, old, new
+            )
+
+
+COLD_START = """
+import json, socket, sys
+from openprocurement.auction.prefork import run_auction
+connection = socket.fromfd({fd}, socket.AF_UNIX, socket.SOCK_STREAM)
+run_auction(json.loads(sys.argv[1]), json.loads(sys.argv[2]), connection)
+"""
+
+
+@benchmark
+def startup(number=5):
+    """
+    Time from launch to a scheduled auction (``schedule_auction`` done),
+    needs the CouchDB and Redis of AUCTION_WORKER_CONFIG
+    (default etc/auction_worker_defaults.json)
+    """
+    import json
+    import os
+    import signal
+    import socket
+    import subprocess
+    import sys
+    import tempfile
+    import time
+    from openprocurement.auction.prefork import (
+        WorkersPool, handoff, prepare_worker, run_auction, STATUS_SCHEDULED
+    )
+
+    config = os.environ.get('AUCTION_WORKER_CONFIG',
+                            os.path.join('etc', 'auction_worker_defaults.json'))
+    if not os.path.isfile(config):
+        print "skipped: worker config {} not exists".format(config)
+        return
+    with open(config) as config_file:
+        worker_defaults = json.load(config_file)
+    request = {
+        'tender_id': '11111111111111111111111111111111',
+        'auction_info': os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     'data', 'tender_data.json')
+    }
+
+    def cold_start():
+        connection, child = socket.socketpair()
+        process = subprocess.Popen(
+            [sys.executable, '-c', COLD_START.format(fd=child.fileno()),
+             json.dumps(worker_defaults), json.dumps(request)],
+            close_fds=False
+        )
+        child.close()
+        status = json.loads(connection.makefile().readline())['status']
+        # Closing the connection stops the auction
+        connection.close()
+        process.wait()
+        return status
+
+    def warm_start():
+        return handoff(socket_path, request['tender_id'],
+                       auction_info=request['auction_info'],
+                       wait=STATUS_SCHEDULED)['status']
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'pool.sock')
+    master = os.fork()
+    if master == 0:
+        try:
+            WorkersPool(
+                socket_path,
+                lambda request, connection: run_auction(worker_defaults, request, connection),
+                size=2, prepare=prepare_worker
+            ).run()
+        finally:
+            os._exit(0)
+    results = {'cold': 0.0, 'warm': 0.0}
+    try:
+        for run in xrange(number):
+            for name, start in (('cold', cold_start), ('warm', warm_start)):
+                # Let the pool replace the child taken by the previous run
+                time.sleep(3)
+                started_at = time.time()
+                status = start()
+                results[name] += time.time() - started_at
+                assert status == STATUS_SCHEDULED, status
+    finally:
+        os.kill(master, signal.SIGTERM)
+        os.waitpid(master, 0)
+    print "runs: {} cold start: {:.4f}s hand-off: {:.4f}s".format(
+        number, results['cold'], results['warm']
+    )
+
+
+@benchmark
+def sse_fanout(clients=1000, number=20):
+    from flask import Flask
+    from gevent.queue import Queue
+    from openprocurement.auction.event_source import (
+        SseStream, send_event, send_event_to_client
+    )
+
+    app = Flask(__name__)
+    app.auction_bidders = {"bidder": {"clients": {}, "channels": {}}}
+    channels = app.auction_bidders["bidder"]["channels"]
+    streams = []
+    for client in xrange(clients):
+        channels[client] = Queue()
+        streams.append(iter(SseStream(channels[client])))
+        next(streams[-1])  # CHUNK
+        next(streams[-1])  # retry
+
+    def per_client():
+        for client in channels:
+            send_event_to_client("bidder", client, {"time": "2015-04-24T11:07:30+03:00"}, "Tick")
+        for stream in streams:
+            next(stream), next(stream), next(stream)  # event, data, blank line
+
+    def broadcast():
+        send_event("bidder", {"time": "2015-04-24T11:07:30+03:00"}, "Tick")
+        for stream in streams:
+            next(stream)
+
+    with app.app_context():
+        old = timeit(per_client, number=number)
+        new = timeit(broadcast, number=number)
+    print "clients: {} ticks: {} per client: {:.4f}s broadcast: {:.4f}s".format(
+        clients, number, old, new
+    )
+
+
+@benchmark
+def bids(number=5000):
+    from fractions import Fraction
+    from openprocurement.auction.forms import BidsForm, BidsValidator
+
+    class Auction(object):
+        bidders_index = dict(
+            (str(bidder), {'coeficient': Fraction(bidder + 10, 11)})
+            for bidder in xrange(10)
+        )
+
+    document = prepare_auction_document(10)
+    document["minimalStep"] = {"amount": 10.0}
+    document["stages"][1].update(type="bids", bidder_id="1", amount=1000, amount_features="2000")
+    for features in (None, [{}]):
+        auction = Auction()
+        auction.features = features
+        validator = BidsValidator(auction)
+        bid = {"bidder_id": "1", "bid": 900.0}
+
+        def with_form():
+            form = BidsForm.from_json(bid)
+            form.auction = auction
+            form.document = document
+            return form.validate()
+
+        assert with_form() and not validator.validate(bid, document)[1]
+        form = timeit(with_form, number=number)
+        compiled = timeit(lambda: validator.validate(bid, document), number=number)
+        print "features: {:d} BidsForm: {:.0f} bids/s validator: {:.0f} bids/s".format(
+            bool(features), number / form, number / compiled
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Auction benchmarks ----')
+    parser.add_argument('names', nargs='*',
+                        help='Benchmarks to run: {} (default: all)'.format(
+                            ', '.join(sorted(BENCHMARKS))))
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: {}'.format(name))
+    for name in args.names or sorted(BENCHMARKS):
+        print "==== {} ====".format(name)
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import json
+import os.path
+import unittest
+from copy import deepcopy
+
+from mock import MagicMock
+
+from openprocurement.auction.auction_worker import Auction
+
+PWD = os.path.dirname(os.path.realpath(__file__))
+TENDER_ID = "11111111111111111111111111111111"
+WORKER_DEFAULTS = {
+    "TENDERS_API_URL": "http://localhost:6543/",
+    "TENDERS_API_VERSION": "0.9",
+    "COUCH_DATABASE": "http://localhost:5984/auctions",
+    "REDIS_URL": "redis://localhost:6379/0"
+}
+
+with open(os.path.join(PWD, "data", "tender_data.json")) as tender_file:
+    TENDER_DATA = json.load(tender_file)
+
+
+def prepare_auction():
+    auction = Auction(TENDER_ID, worker_defaults=WORKER_DEFAULTS,
+                      auction_data=deepcopy(TENDER_DATA))
+    auction.persister = MagicMock()
+    auction.get_auction_info()
+    auction.prepare_audit()
+    auction.auction_document = {
+        "_id": TENDER_ID, "current_stage": -1,
+        "initial_bids": [], "stages": [], "results": []
+    }
+    auction.prepare_auction_stages()
+    return auction
+
+
+def bid(auction, amount, minute):
+    stage = auction.auction_document["current_stage"]
+    auction.add_bid(stage, {
+        "bidder_id": auction.auction_document["stages"][stage]["bidder_id"],
+        "amount": amount,
+        "time": "2016-03-02T16:{:02d}:00+02:00".format(minute)
+    })
+
+
+def round_order(auction, round_number):
+    start, end = auction.get_round_stages(round_number)
+    return [(stage["bidder_id"], stage["amount"])
+            for stage in auction.auction_document["stages"][start:end]]
+
+
+class RoundsOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.auction = prepare_auction()
+        self.auction.start_auction()
+        self.auction.end_first_pause()
+
+    def play_round(self, amounts, minute):
+        for amount in amounts:
+            if amount:
+                bid(self.auction, amount, minute)
+                minute += 1
+            self.auction.end_bids_stage()
+        self.auction.next_stage()
+
+    def test_next_rounds_follow_latest_bids(self):
+        first, second = [bidder for bidder, _ in round_order(self.auction, 1)]
+        self.assertEqual(round_order(self.auction, 1),
+                         [(first, 480000.0), (second, 475000.0)])
+
+        # First bidder undercuts, order of round 2 and 3 swaps
+        self.play_round([440000.0, None], 1)
+        expected = [(second, 475000.0), (first, 440000.0)]
+        self.assertEqual(round_order(self.auction, 2), expected)
+        self.assertEqual(round_order(self.auction, 3), expected)
+
+        # Second bidder undercuts again in round 2, only round 3 changes
+        self.play_round([430000.0, None], 3)
+        self.assertEqual(round_order(self.auction, 2),
+                         [(second, 430000.0), (first, 440000.0)])
+        self.assertEqual(round_order(self.auction, 3),
+                         [(first, 440000.0), (second, 430000.0)])
+        stages = self.auction.auction_document["stages"]
+        start = self.auction.get_round_stages(3)[0]
+        self.assertEqual(stages[start]["label"]["en"],
+                         "Bidder #{}".format(self.auction.mapping[first]))
+        self.assertNotEqual(stages[start]["start"], stages[start + 1]["start"])
+
+    def test_sealed_stage_rejects_late_bid(self):
+        stage = self.auction.auction_document["current_stage"]
+        bidder_id = self.auction.auction_document["stages"][stage]["bidder_id"]
+        bid(self.auction, 440000.0, 1)
+        self.auction.end_bids_stage()
+        self.assertFalse(self.auction.add_bid(stage, {
+            "bidder_id": bidder_id, "amount": 430000.0,
+            "time": "2016-03-02T16:02:00+02:00"
+        }))
+        self.assertEqual(self.auction.auction_document["stages"][stage]["amount"], 440000.0)
+
+    def test_resumed_worker_ends_bids_stage(self):
+        self.play_round([440000.0, None], 1)
+
+        # Worker restarted in the middle of round 2 never ran start_auction
+        resumed = prepare_auction()
+        resumed.auction_document = deepcopy(self.auction.auction_document)
+        for worker in (self.auction, resumed):
+            bid(worker, 420000.0, 5)
+            worker.end_bids_stage()
+        self.assertEqual(resumed.auction_document["stages"],
+                         self.auction.auction_document["stages"])
+        self.assertEqual(round_order(resumed, 3)[-1][1], 420000.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from gevent import idle, spawn
+from gevent.event import AsyncResult
+from gevent.pool import Pool
+
+from openprocurement.auction.databridge import AuctionsDataBridge, FeedCursor
+
+START_DATE = "2099-01-01T10:00:00+02:00"
+
+
+def change(seq, start=START_DATE):
+    return {"id": "a{}".format(seq), "seq": seq,
+            "doc": {"stages": [{"start": start}]}}
+
+
+class Worker(object):
+    """Auction worker commands which finish when the test says so"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, cmd, tender_id, **kw):
+        result = AsyncResult()
+        self.calls.append((cmd, tender_id, result))
+        return result.get()
+
+    def finish(self, index, result=0):
+        self.calls[index][2].set(result)
+        idle()
+
+
+class Client(object):
+    """Tenders feed client serving pages with offsets 1, 2, ..."""
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.params = {}
+        self.headers = {}
+
+    def get_tenders(self):
+        if not self.pages:
+            return []
+        self.params["offset"] = self.params.get("offset", 0) + 1
+        return self.pages.pop(0)
+
+
+class DataBridgeStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {"main": {
+            "tenders_api_server": "http://localhost:6543",
+            "tenders_api_version": "0.9",
+            "couch_url": "http://localhost:5984/",
+            "auctions_db": "auctions",
+            "state_file": os.path.join(self.tmp_dir, "state.json"),
+            "state_save_interval": 0,
+            "planning_pool_size": 1,
+            "planning_batch_size": 1
+        }}
+        self.bridge = self.prepare_bridge()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def prepare_bridge(self):
+        bridge = AuctionsDataBridge(self.config)
+        bridge.last_seq_id = 0
+        bridge.feed_cursor = FeedCursor(bridge.save_seq_state)
+        bridge.run_auction_worker_cmd = self.worker = Worker()
+        return bridge
+
+    def saved_state(self):
+        idle()
+        if not os.path.isfile(self.config["main"]["state_file"]):
+            return {}
+        with open(self.config["main"]["state_file"]) as state_file:
+            return json.load(state_file)
+
+    def feed(self, *items):
+        for item in items:
+            self.bridge.last_seq_id = item["seq"]
+            feed_entry = self.bridge.feed_cursor.hold(item["seq"])
+            self.bridge.handle_change(item, feed_entry)
+            self.bridge.feed_cursor.release(feed_entry)
+        idle()
+
+    def test_position_waits_for_planning(self):
+        self.feed(change(1), change(2))
+        self.assertEqual([call[1] for call in self.worker.calls], ["a1"])
+        self.assertEqual(self.saved_state(), {})
+
+        self.worker.finish(0)
+        self.assertEqual(self.saved_state(), {
+            "last_seq_id": 1, "planned_tenders": {"a1": START_DATE}
+        })
+        self.worker.finish(1)
+        self.assertEqual(self.saved_state()["last_seq_id"], 2)
+
+    def test_failed_planning_keeps_position(self):
+        self.feed(change(1), change(2))
+        self.worker.finish(0, None)
+        self.worker.finish(1)
+        self.assertEqual(self.saved_state(), {})
+
+    def test_feed_waits_for_heap_slots(self):
+        self.config["main"]["planning_heap_size"] = 1
+        self.bridge = self.prepare_bridge()
+        consumer = spawn(self.feed, change(1), change(2), change(3))
+        idle()
+        # First auction is being planned, second one fills the heap
+        self.assertEqual(len(self.worker.calls), 1)
+        self.assertEqual(len(self.bridge.planning_heap), 1)
+        self.assertFalse(consumer.ready())
+
+        self.worker.finish(0)
+        self.assertEqual(len(self.worker.calls), 2)
+        self.assertEqual([item[2] for item in self.bridge.planning_heap], ["a3"])
+        self.assertTrue(consumer.ready())
+        self.worker.finish(1)
+        self.worker.finish(2)
+        self.assertEqual(self.saved_state()["last_seq_id"], 3)
+
+    def test_state_round_trip(self):
+        self.bridge.save_seq_state(7)
+        self.bridge.planned_tenders = {
+            "a1": START_DATE, "a2": "2001-01-01T10:00:00+02:00"
+        }
+        self.bridge.save_seq_state(8)
+        idle()
+
+        bridge = self.prepare_bridge()
+        self.assertEqual(bridge.state, {
+            "last_seq_id": 8, "planned_tenders": {"a1": START_DATE}
+        })
+
+    def test_filtered_changes_advance_cursor(self):
+        self.bridge.planned_tenders = {"a1": START_DATE}
+
+        class Database(object):
+            def changes(self, **kw):
+                return iter([change(1), {"last_seq": 3}])
+        self.bridge.db = Database()
+        self.bridge.handle_continuous_feed()
+        self.assertEqual(self.worker.calls, [])
+        self.assertEqual(self.saved_state()["last_seq_id"], 3)
+
+    def test_offset_waits_for_worker_commands(self):
+        self.bridge.feed_cursor = FeedCursor(
+            lambda offset: self.bridge.save_state(offset=offset))
+        self.bridge.client = Client([
+            [{"id": "t1", "status": "active.qualification",
+              "lots": [{"id": "l1", "status": "active"}]}],
+            [{"id": "t2", "status": "cancelled"}]
+        ])
+        self.bridge.lookup_auctions = lambda tenders_list: (
+            set(), set(["t1_l1"]), set(["t2"]))
+        self.bridge.planning_pool = Pool(2)
+        self.assertEqual(list(self.bridge.get_teders_list()), [])
+        idle()
+        self.assertEqual([call[:2] for call in self.worker.calls],
+                         [("announce", "t1"), ("cancel", "t2")])
+        self.assertEqual(self.saved_state(), {})
+
+        self.worker.finish(0)
+        self.assertEqual(self.saved_state(), {"offset": 1})
+        self.worker.finish(1, None)
+        self.assertEqual(self.saved_state(), {"offset": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
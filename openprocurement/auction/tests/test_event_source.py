@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from flask import Flask
+from gevent import idle
+from gevent.queue import Queue
+from mock import MagicMock
+from pytz import utc
+
+from openprocurement.auction.event_source import (
+    ClientChannel, SseStream, TickBroadcaster, OVERFLOW_DISCONNECT, sse_event,
+    event_name
+)
+
+
+def drain(channel):
+    messages = []
+    while channel.qsize():
+        message = channel.get()
+        data = message.data if hasattr(message, 'frame') else message.get('data')
+        messages.append((event_name(message), data))
+    return messages
+
+
+class ClientChannelTest(unittest.TestCase):
+
+    def test_coalesce_keeps_latest_ticks_and_clients_lists(self):
+        channel = ClientChannel(max_size=3)
+        channel.put(sse_event(1, "Tick"))
+        channel.put({"event": "BidsUpdated", "data": 1})
+        channel.put(sse_event(["a"], "ClientsList"))
+        channel.put(sse_event(2, "Tick"))
+        channel.put(sse_event(["a", "b"], "ClientsList"))
+        self.assertFalse(channel.closed)
+        self.assertEqual(drain(channel), [
+            ("BidsUpdated", 1), ("Tick", 2), ("ClientsList", ["a", "b"])
+        ])
+
+    def test_overflow_disconnects_client(self):
+        on_disconnect = MagicMock()
+        channel = ClientChannel(max_size=2, on_disconnect=on_disconnect)
+        for amount in range(3):
+            channel.put({"event": "BidsUpdated", "data": amount})
+        self.assertTrue(channel.closed)
+        on_disconnect.assert_called_once_with()
+
+        channel.put({"event": "BidsUpdated", "data": 3})
+        self.assertEqual(drain(channel), [("StopSSE", None)])
+
+    def test_disconnect_policy_does_not_coalesce(self):
+        channel = ClientChannel(max_size=1, overflow=OVERFLOW_DISCONNECT)
+        channel.put(sse_event(1, "Tick"))
+        channel.put(sse_event(2, "Tick"))
+        self.assertTrue(channel.closed)
+        self.assertEqual(drain(channel), [("StopSSE", None)])
+
+    def test_stopped_stream_closes_channel(self):
+        on_close = MagicMock()
+        channel = ClientChannel()
+        channel.put({"event": "StopSSE"})
+        stream = SseStream(channel, on_close=on_close)
+        list(stream)
+        stream.close()
+        on_close.assert_called_once_with()
+
+
+class TickBroadcasterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000000000.0
+        self.sleeps = []
+        self.wakeups = Queue()
+        self.app = Flask(__name__)
+        self.app.auction_bidders = {}
+        self.app.config['timezone'] = utc
+        self.app.config['auction'] = MagicMock(auction_document={})
+        self.ticks = TickBroadcaster(interval=5, clock=lambda: self.now,
+                                     sleep=self.sleep)
+        self.ticks.subscribe(self.app)
+
+    def tearDown(self):
+        if self.ticks.apps:
+            self.ticks.unsubscribe(self.app)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += self.wakeups.get()
+
+    def elapse(self):
+        """Wake up the timer at the time it asked for"""
+        self.wakeups.put(self.sleeps[-1])
+        idle()
+
+    def connect(self):
+        channel = ClientChannel()
+        self.app.auction_bidders["bidder"] = {"clients": {}, "channels": {"client": channel}}
+        self.ticks.wakeup()
+        idle()
+        return channel
+
+    def test_no_ticks_without_clients(self):
+        self.app.auction_bidders["bidder"] = {"clients": {}, "channels": {}}
+        self.ticks.wakeup()
+        idle()
+        self.assertEqual(self.sleeps, [])
+        self.assertFalse(self.ticks.clients_connected.is_set())
+
+    def test_connected_client_gets_ticks(self):
+        channel = self.connect()
+        self.assertEqual(self.sleeps, [5.0])
+        self.elapse()
+        self.elapse()
+        self.assertEqual(drain(channel), [
+            ("Tick", {"time": "2001-09-09T01:46:45+00:00"}),
+            ("Tick", {"time": "2001-09-09T01:46:50+00:00"})
+        ])
+
+    def test_tick_on_next_stage_start(self):
+        self.app.config['auction'].auction_document = {
+            "current_stage": 0,
+            "stages": [{"start": "2001-09-09T01:46:00+00:00"},
+                       {"start": "2001-09-09T01:46:42+00:00"}]
+        }
+        self.connect()
+        self.assertEqual(self.sleeps, [2.0])
+
+    def test_unsubscribe_stops_timer(self):
+        timer = self.ticks.timer
+        self.ticks.unsubscribe(self.app)
+        idle()
+        self.assertTrue(timer.dead)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from gevent import idle
+from gevent.queue import Queue
+from mock import MagicMock
+
+from openprocurement.auction.persistence import WriteBehindPersister
+
+
+class WriteBehindPersisterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.save = MagicMock()
+        self.ticks = Queue()
+        self.persister = WriteBehindPersister(
+            self.save, sleep=lambda seconds: self.ticks.get())
+
+    def tearDown(self):
+        self.persister.stop()
+
+    def elapse(self):
+        """End the flush interval the persister waits for"""
+        idle()
+        self.ticks.put(None)
+        idle()
+
+    def test_schedules_coalesce_into_one_save(self):
+        for _ in range(3):
+            self.persister.schedule()
+        idle()
+        self.assertEqual(self.save.call_count, 0)
+        self.elapse()
+        self.assertEqual(self.save.call_count, 1)
+
+    def test_flush_writes_pending_save_once(self):
+        self.persister.schedule()
+        self.persister.flush()
+        self.assertEqual(self.save.call_count, 1)
+        self.elapse()
+        self.assertEqual(self.save.call_count, 1)
+
+    def test_no_save_after_stop(self):
+        self.persister.schedule()
+        self.persister.flush()
+        self.persister.schedule()
+        self.persister.stop()
+        self.elapse()
+        self.assertEqual(self.save.call_count, 1)
+
+    def test_failed_save_is_retried_on_next_schedule(self):
+        self.save.side_effect = [Exception("conflict"), None]
+        self.persister.schedule()
+        self.elapse()
+        self.assertEqual(self.save.call_count, 1)
+        self.persister.schedule()
+        self.elapse()
+        self.assertEqual(self.save.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
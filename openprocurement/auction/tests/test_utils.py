@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from datetime import datetime
+
+from gevent import idle
+from gevent.queue import Queue
+from mock import MagicMock
+from pytz import utc
+
+from openprocurement.auction.utils import LoginsCache, ProxyMappings
+
+
+class LoginsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000000000.0
+        self.cache = LoginsCache(ttl=20, negative_ttl=10, clock=lambda: self.now)
+
+    def test_grant_kept_until_expires(self):
+        expires = datetime.fromtimestamp(self.now + 50, utc)
+        request = MagicMock(return_value={'bidder_id': 'b', 'expires': expires.isoformat()})
+        self.cache.fetch('token', request)
+        self.now += 30
+        self.cache.fetch('token', request)
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(self.cache.grant_expires('token'), expires)
+
+        self.now += 30
+        self.assertIsNone(self.cache.grant_expires('token'))
+        self.cache.fetch('token', request)
+        self.assertEqual(request.call_count, 2)
+
+    def test_grant_without_expiry_kept_for_ttl(self):
+        request = MagicMock(return_value={'bidder_id': 'b'})
+        self.cache.fetch('token', request)
+        self.assertIsNone(self.cache.grant_expires('token'))
+        self.now += 10
+        self.cache.fetch('token', request)
+        self.assertEqual(request.call_count, 1)
+        self.now += 10
+        self.cache.fetch('token', request)
+        self.assertEqual(request.call_count, 2)
+
+    def test_rejected_token_expires(self):
+        request = MagicMock(return_value=False)
+        self.assertFalse(self.cache.fetch('token', request))
+        self.assertFalse(self.cache.fetch('token', request))
+        self.assertEqual(request.call_count, 1)
+        self.now += 10
+        self.cache.fetch('token', request)
+        self.assertEqual(request.call_count, 2)
+
+    def test_failed_request_is_not_cached(self):
+        request = MagicMock(return_value=None)
+        self.assertIsNone(self.cache.fetch('token', request))
+        self.assertIsNone(self.cache.fetch('token', request))
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 2, 'size': 0})
+
+
+class PubSub(object):
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def subscribe(self, channel):
+        self.messages.put({'type': 'subscribe', 'channel': channel})
+
+    def listen(self):
+        return iter(self.messages.get, None)
+
+
+class Redis(dict):
+
+    def __init__(self):
+        super(Redis, self).__init__()
+        self.messages = Queue()
+        self.reads = 0
+
+    def get(self, key):
+        self.reads += 1
+        return super(Redis, self).get(key)
+
+    def pubsub(self):
+        return PubSub(self.messages)
+
+    def publish(self, auction_id, url):
+        self[auction_id] = url
+        self.messages.put({'type': 'message', 'data': json.dumps({'id': auction_id, 'url': url})})
+
+
+class ProxyMappingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis()
+        self.mappings = ProxyMappings(self.redis)
+        idle()
+
+    def tearDown(self):
+        self.mappings.listener.kill()
+
+    def test_found_mapping_is_cached(self):
+        self.redis['auction'] = 'http://worker:1/'
+        self.assertEqual(self.mappings.get('auction'), 'http://worker:1/')
+        self.assertEqual(self.mappings.get('auction'), 'http://worker:1/')
+        self.assertEqual(self.redis.reads, 1)
+
+    def test_published_change_replaces_mapping(self):
+        self.redis['auction'] = 'http://worker:1/'
+        self.mappings.get('auction')
+        self.redis.publish('auction', 'http://worker:2/')
+        idle()
+        self.assertEqual(self.mappings.get('auction'), 'http://worker:2/')
+        self.assertEqual(self.redis.reads, 1)
+
+    def test_expire_rereads_mapping(self):
+        self.redis['auction'] = 'http://worker:1/'
+        self.mappings.get('auction')
+        self.redis['auction'] = 'http://worker:2/'
+        self.mappings.expire('auction')
+        self.assertEqual(self.mappings.get('auction'), 'http://worker:2/')
+
+    def test_miss_is_not_cached(self):
+        self.assertIsNone(self.mappings.get('auction'))
+        self.redis['auction'] = 'http://worker:1/'
+        self.assertEqual(self.mappings.get('auction'), 'http://worker:1/')
+
+    def test_resubscribe_drops_cached_mappings(self):
+        self.redis['auction'] = 'http://worker:1/'
+        self.mappings.get('auction')
+        self.redis['auction'] = 'http://worker:2/'
+        self.redis.messages.put({'type': 'subscribe', 'channel': self.mappings.channel})
+        idle()
+        self.assertEqual(self.mappings.get('auction'), 'http://worker:2/')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,10 +5,13 @@ except ImportError:
     pass
 
 import iso8601
+from collections import OrderedDict
 from datetime import MINYEAR, datetime
-from pytz import timezone
-from gevent import sleep
+from pytz import timezone, utc
+from gevent import sleep, spawn
+from gevent.event import AsyncResult
 import logging
+import time
 import json
 import requests
 from hashlib import sha1
@@ -18,16 +21,118 @@ from gevent.baseserver import parse_address
 from redis import Redis
 import uuid
 
+from copy import deepcopy
 from pkg_resources import parse_version
 from restkit.wrappers import BodyWrapper
 from barbecue import chef
 from fractions import Fraction
 
 
+LOGGER = logging.getLogger(__name__)
+
 EXTRA_LOGGING_VALUES = {
     'X-Request-ID': 'JOURNAL_REQUEST_ID',
     'X-Clint-Request-ID': 'JOURNAL_CLIENT_REQUEST_ID'
 }
+PARSE_CACHE_SIZE = 4096
+MAPPINGS_CACHE_SIZE = 10000
+MAPPINGS_CHANNEL = 'auctions_mappings'
+LOGINS_CACHE_SIZE = 10000
+LOGINS_TTL = 300
+LOGINS_NEGATIVE_TTL = 30
+LOGINS_STATS_INTERVAL = 600
+# Exit code of 'auction_worker planning' for an auction with units not written
+NOT_PLANNED_EXIT_CODE = 3
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+MIN_BID_TIME = datetime(MINYEAR, 1, 1, tzinfo=timezone('Europe/Kiev'))
+
+
+class LRUCache(object):
+    """
+    >>> cache = LRUCache(2)
+    >>> cache.set('a', 1); cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        return self._data.items()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+
+PARSED_DATES = LRUCache(PARSE_CACHE_SIZE)
+PARSED_TIMESTAMPS = LRUCache(PARSE_CACHE_SIZE)
+
+
+class BidsLog(object):
+    """
+    Append-only bids log per auction stage. A sealed stage rejects bids
+
+    >>> log = BidsLog()
+    >>> log.append(1, {'amount': 1})
+    True
+    >>> log.seal(1)
+    [{'amount': 1}]
+    >>> log.append(1, {'amount': 2})
+    False
+    >>> 1 in log, 2 in log, log[1]
+    (True, False, [{'amount': 1}])
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.sealed = set()
+
+    def __contains__(self, stage):
+        return stage in self.stages
+
+    def __getitem__(self, stage):
+        return self.stages[stage]
+
+    def append(self, stage, bid):
+        if stage in self.sealed:
+            return False
+        self.stages.setdefault(stage, []).append(bid)
+        return True
+
+    def seal(self, stage):
+        self.sealed.add(stage)
+        return self.stages.get(stage, [])
 
 
 def generate_request_id(prefix=b'auction-req-'):
@@ -59,6 +164,47 @@ def filter_start_bids_by_bidder_id(bids, bidder):
             if bid['bidders'][0]['id']['name'] == bidder]
 
 
+def parse_date(datetime_stamp, tz=None):
+    """
+    >>> parse_date("2015-01-04T15:40:44Z") is parse_date("2015-01-04T15:40:44Z")
+    True
+    >>> parse_date("2015-01-04T15:40:44Z", timezone('Europe/Kiev')).isoformat()
+    '2015-01-04T17:40:44+02:00'
+    """
+    key = (datetime_stamp, repr(tz))
+    date = PARSED_DATES.get(key)
+    if date is None:
+        date = iso8601.parse_date(datetime_stamp)
+        if tz is not None:
+            date = date.astimezone(tz)
+        PARSED_DATES.set(key, date)
+    return date
+
+
+def to_timestamp(date):
+    """
+    Microseconds since epoch
+
+    >>> to_timestamp(parse_date("1970-01-01T00:00:01.5Z"))
+    1500000
+    """
+    delta = date - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def get_timestamp(item):
+    """
+    >>> get_timestamp({"time": "2015-01-04T15:40:44Z"}) < get_timestamp({"date": "2015-01-04T15:40:44.1Z"})
+    True
+    """
+    datetime_stamp = item.get('time', '') or item.get('date', '')
+    timestamp = PARSED_TIMESTAMPS.get(datetime_stamp)
+    if timestamp is None:
+        timestamp = to_timestamp(get_time(item))
+        PARSED_TIMESTAMPS.set(datetime_stamp, timestamp)
+    return timestamp
+
+
 def get_time(item):
     """
     >>> date = get_time({"time": "2015-01-04T15:40:44Z"}) # doctest: +NORMALIZE_WHITESPACE
@@ -77,14 +223,27 @@ def get_time(item):
                      tm_sec=0, tm_wday=6, tm_yday=366, tm_isdst=0)
     """
     if item.get('time', ''):
-        bid_time = iso8601.parse_date(item['time'])
+        bid_time = parse_date(item['time'])
     elif item.get('date', ''):
-        bid_time = iso8601.parse_date(item['date'])
+        bid_time = parse_date(item['date'])
     else:
-        bid_time = datetime(MINYEAR, 1, 1, tzinfo=timezone('Europe/Kiev'))
+        bid_time = MIN_BID_TIME
     return bid_time
 
 
+def bid_sort_key(bid, with_features=False):
+    """
+    >>> bid_sort_key({'amount': 3955.0, 'amount_features': '7910/3', 'time': ''},
+    ...              with_features=True)[0]
+    Fraction(7910, 3)
+    """
+    if with_features:
+        amount = Fraction(bid["amount_features"])
+    else:
+        amount = bid["amount"]
+    return amount, get_timestamp(bid)
+
+
 def sorting_by_amount(bids, reverse=True):
     """
     >>> bids = [
@@ -106,22 +265,17 @@ def sorting_by_amount(bids, reverse=True):
     [{'amount': 3966.0, 'bidder_id': 'df4', 'time': '2015-04-24T11:07:40+03:00'},
      {'amount': 3966.0, 'bidder_id': 'df2', 'time': '2015-04-24T11:07:30+03:00'},
      {'amount': 3966.0, 'bidder_id': 'df1', 'time': '2015-04-24T11:07:20+03:00'}]
-    """
-    def bids_compare(bid1, bid2):
-        if "amount_features" in bid1 and "amount_features" in bid2:
-            full_amount_bid1 = Fraction(bid1["amount_features"])
-            full_amount_bid2 = Fraction(bid2["amount_features"])
-        else:
-            full_amount_bid1 = bid1["amount"]
-            full_amount_bid2 = bid2["amount"]
-        if full_amount_bid1 == full_amount_bid2:
-            time_of_bid1 = get_time(bid1)
-            time_of_bid2 = get_time(bid2)
-            return - cmp(time_of_bid2, time_of_bid1)
-        else:
-            return cmp(full_amount_bid1, full_amount_bid2)
 
-    return sorted(bids, reverse=reverse, cmp=bids_compare)
+    >>> bids = [
+    ...     {'amount': 3955.0, 'amount_features': '7910', 'bidder_id': 'df1', 'time': ''},
+    ...     {'amount': 3966.0, 'amount_features': '3966', 'bidder_id': 'df2', 'time': ''},
+    ... ]
+    >>> [bid['bidder_id'] for bid in sorting_by_amount(bids)]
+    ['df1', 'df2']
+    """
+    with_features = all("amount_features" in bid for bid in bids)
+    return sorted(bids, reverse=reverse,
+                  key=lambda bid: bid_sort_key(bid, with_features))
 
 
 def sorting_start_bids_by_amount(bids, features=None, reverse=True):
@@ -152,13 +306,20 @@ def sorting_by_time(bids, reverse=True):
 
 
 def get_latest_bid_for_bidder(bids, bidder_id):
-    return sorted(filter_by_bidder_id(bids, bidder_id),
-                  key=get_time, reverse=True)[0]
+    """
+    >>> bids = [
+    ...     {"bidder_id": "1", "amount": 100, "time": "2015-01-04T15:40:44Z"},
+    ...     {"bidder_id": "1", "amount": 200, "time": "2015-01-04T15:40:45Z"},
+    ...     {"bidder_id": "2", "amount": 101, "time": "2015-01-04T15:40:46Z"}
+    ... ]
+    >>> get_latest_bid_for_bidder(bids, "1")["amount"]
+    200
+    """
+    return max(filter_by_bidder_id(bids, bidder_id), key=get_timestamp)
 
 
 def get_latest_start_bid_for_bidder(bids, bidder):
-    return sorted(filter_start_bids_by_bidder_id(bids, bidder),
-                  key=get_time, reverse=True)[0]
+    return max(filter_start_bids_by_bidder_id(bids, bidder), key=get_timestamp)
 
 
 def get_tender_data(tender_url, user="", password="", retry_count=10,
@@ -313,14 +474,78 @@ def get_lisener(port, host=''):
     return lisener
 
 
+REDIS_CLIENTS = {}
+
+
+def get_redis(redis_url):
+    """Redis client shared per url, so its connection pool is reused"""
+    if redis_url not in REDIS_CLIENTS:
+        REDIS_CLIENTS[redis_url] = Redis.from_url(redis_url)
+    return REDIS_CLIENTS[redis_url]
+
+
+def publish_mapping(redis_url, auction_id, auction_url=None):
+    pipeline = get_redis(redis_url).pipeline()
+    if auction_url:
+        pipeline.set(auction_id, auction_url)
+    else:
+        pipeline.delete(auction_id)
+    pipeline.publish(MAPPINGS_CHANNEL,
+                     json.dumps({'id': auction_id, 'url': auction_url}))
+    return pipeline.execute()[0]
+
+
 def create_mapping(redis_url, auction_id, auction_url):
-    mapings = Redis.from_url(redis_url)
-    return mapings.set(auction_id, auction_url)
+    return publish_mapping(redis_url, auction_id, auction_url)
 
 
 def delete_mapping(redis_url, auction_id):
-    mapings = Redis.from_url(redis_url)
-    return mapings.delete(auction_id)
+    return publish_mapping(redis_url, auction_id)
+
+
+class ProxyMappings(object):
+    """
+    Local cache of auction_id -> worker url mappings kept in sync with
+    changes published by create_mapping and delete_mapping
+    """
+
+    def __init__(self, redis, max_size=MAPPINGS_CACHE_SIZE, channel=MAPPINGS_CHANNEL):
+        self.redis = redis
+        self.channel = channel
+        self.cache = LRUCache(max_size)
+        self.subscribed = False
+        self.listener = spawn(self.listen)
+
+    def get(self, auction_id):
+        if self.subscribed and auction_id in self.cache:
+            return self.cache.get(auction_id)
+        auction_url = self.redis.get(auction_id)
+        # Published change received while reading wins, misses are not
+        # cached as a mapping may be created without a published change
+        if auction_url is not None and self.subscribed and auction_id not in self.cache:
+            self.cache.set(auction_id, auction_url)
+        return auction_url
+
+    def expire(self, auction_id):
+        self.cache.pop(auction_id)
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        # Changes may have been missed while unsubscribed
+                        self.cache.clear()
+                        self.subscribed = True
+                    elif message['type'] == 'message':
+                        mapping = json.loads(message['data'])
+                        self.cache.set(mapping['id'], mapping['url'])
+            except Exception, e:
+                LOGGER.warning("Mappings subscription error: {}".format(e))
+            self.subscribed = False
+            sleep(1)
 
 
 def prepare_extra_journal_fields(headers):
@@ -358,17 +583,97 @@ class StreamWrapper(BodyWrapper):
                 raise StopIteration
 
 
+class LoginsCache(object):
+    """
+    Bounded cache of OAuth "me" responses by access token. Grants are kept
+    until their "expires" (parsed once), rejected (False) tokens for
+    negative_ttl seconds, failed (None) requests are not cached. Concurrent
+    misses of a token share one OAuth request
+
+    >>> cache = LoginsCache(3)
+    >>> grant = {'bidder_id': 'b', 'expires': '2100-01-01T00:00:00Z'}
+    >>> cache.fetch('t1', lambda: grant) is cache.fetch('t1', lambda: 1 / 0)
+    True
+    >>> cache.fetch('t2', lambda: False), cache.fetch('t2', lambda: 1 / 0)
+    (False, False)
+    >>> cache.fetch('t3', lambda: None), cache.fetch('t3', lambda: False)
+    (None, False)
+    >>> cache.grant_expires('t1').isoformat()
+    '2100-01-01T00:00:00+00:00'
+    >>> sorted(cache.stats().items())
+    [('hits', 2), ('misses', 4), ('size', 3)]
+    """
+
+    def __init__(self, max_size=LOGINS_CACHE_SIZE, ttl=LOGINS_TTL,
+                 negative_ttl=LOGINS_NEGATIVE_TTL, clock=time.time):
+        self.cache = LRUCache(max_size)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, token):
+        entry = self.cache.get(token)
+        if entry is not None:
+            if entry[2] > self.clock():
+                return entry
+            self.cache.pop(token)
+
+    def set(self, token, data):
+        grant_expires = None
+        if not data:
+            valid_until = self.clock() + self.negative_ttl
+        elif data.get('expires'):
+            grant_expires = parse_date(data['expires'])
+            valid_until = to_timestamp(grant_expires) / 1000000.
+        else:
+            valid_until = self.clock() + self.ttl
+        self.cache.set(token, (data, grant_expires, valid_until))
+
+    def fetch(self, token, request):
+        entry = self.lookup(token)
+        if entry is not None:
+            self.hits += 1
+            return entry[0]
+        if token in self.pending:
+            self.hits += 1
+            return self.pending[token].get()
+        self.misses += 1
+        result = self.pending[token] = AsyncResult()
+        try:
+            data = request()
+            if data is not None:
+                self.set(token, data)
+            result.set(data)
+            return data
+        except Exception, e:
+            result.set_exception(e)
+            raise
+        finally:
+            del self.pending[token]
+
+    def grant_expires(self, token):
+        entry = self.lookup(token)
+        if entry is not None:
+            return entry[1]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache)}
+
+
 def get_bidder_id(app, session):
     if 'remote_oauth' in session and 'client_id' in session:
-        if session['remote_oauth'] in app.logins_cache:
-            return app.logins_cache[session['remote_oauth']]
-        else:
+        def request_me():
             resp = app.remote_oauth.get('me')
             if resp.status == 200:
-                app.logins_cache[session['remote_oauth']] = resp.data
                 return resp.data
-            else:
+            if resp.status in (401, 403):
                 return False
+            # OAuth server failure is not a rejection, next request retries
+            app.logger.warning("OAuth server answered {} on grant check".format(resp.status))
+        return app.logins_cache.fetch(session['remote_oauth'], request_me)
 
 
 def unsuported_browser(request):
@@ -390,3 +695,63 @@ def filter_amount(stage):
     if 'coeficient' in stage:
         del stage['coeficient']
     return stage
+
+
+class PublicDocumentBuilder(object):
+    """
+    Build public copies of the auction document reusing unchanged stages.
+
+    >>> builder = PublicDocumentBuilder()
+    >>> document = {"current_stage": 1, "initial_bids": [], "results": [],
+    ...             "stages": [{"amount": 100, "coeficient": "1.2"},
+    ...                        {"amount": 90, "coeficient": "1.1"}]}
+    >>> public = builder.build(document, hide_amounts=True)
+    >>> public["stages"]
+    [{}, {}]
+    >>> document["stages"][0]["amount"]
+    100
+    >>> document["stages"][1]["time"] = "2015-01-04T15:40:44Z"
+    >>> second = builder.build(document, hide_amounts=True)
+    >>> second["stages"][0] is public["stages"][0]
+    True
+    >>> second["stages"][1]
+    {'time': '2015-01-04T15:40:44Z'}
+    >>> second["stages"][1]["time"] = "changed"
+    >>> builder.build(document, hide_amounts=True)["stages"][1]
+    {'time': '2015-01-04T15:40:44Z'}
+    >>> builder.build(document)["stages"][0] is document["stages"][0]
+    False
+    """
+    SECTIONS = ('initial_bids', 'stages', 'results')
+
+    def __init__(self):
+        self._stages = {}
+
+    def build(self, document, hide_amounts=False):
+        public_document = {}
+        for name, value in document.iteritems():
+            if name in self.SECTIONS:
+                public_document[name] = [
+                    self._public_stage((name, index, hide_amounts), stage)
+                    for index, stage in enumerate(value)
+                ]
+            elif isinstance(value, (dict, list)):
+                public_document[name] = self._public_stage((name, None, False), value)
+            else:
+                public_document[name] = value
+        return public_document
+
+    def _public_stage(self, key, stage):
+        # Returned copies are checked against their pristine version too,
+        # changes made in a built document never reach the live one or
+        # the following builds
+        if key in self._stages:
+            snapshot, pristine, public_stage = self._stages[key]
+            if snapshot == stage and pristine == public_stage:
+                return public_stage
+        snapshot = deepcopy(stage)
+        public_stage = deepcopy(stage)
+        if key[2]:
+            public_stage = filter_amount(public_stage)
+        self._stages[key] = (snapshot, deepcopy(public_stage), public_stage)
+        return public_stage
@@ -44,7 +44,6 @@ setup(name='openprocurement.auction',
           'PyYAML',
           'request_id_middleware',
           'restkit',
-          'PyMemoize',
           'barbecue',
           # ssl warning
           'pyopenssl',
@@ -65,6 +64,8 @@ setup(name='openprocurement.auction',
       entry_points={
           'console_scripts': [
               'auction_worker = openprocurement.auction.auction_worker:main',
+              'auction_worker_pool = openprocurement.auction.prefork:main',
+              'auction_worker_handoff = openprocurement.auction.prefork:handoff_main',
               'auctions_data_bridge = openprocurement.auction.databridge:main',
               'auction_test = openprocurement.auction.tests.main:main [test]'
           ],